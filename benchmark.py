@@ -0,0 +1,293 @@
+# Brick LINES: benchmarks of the parsers, the checker, the interpreter and the rendering
+# Copyright (C) 2024 maehw
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from time import perf_counter
+
+from brick_lines import *
+
+# version of the JSON results; baselines of another version are not compared
+RESULTS_FORMAT = 1
+
+SIZES = (10, 100, 1000, 10000, 100000)
+QUICK_SIZES = (10, 100, 1000)
+COMMODORE_LINES_MAX = 40  # fixed size of Commodore save files
+# import time of the module and time to print a file beyond starting the bare interpreter; exceeding it counts as
+# regression (importing enum takes about 7 ms of the import time)
+STARTUP_BUDGETS = {'startup/import': 0.015, 'startup/print': 0.025}
+
+
+def synthetic_program(num_lines):
+    # blocks of 10 lines using all kinds of structures; with the inputs of a simulated Interface A (open, i.e.
+    # True) the first IF is entered and the second one is skipped; output lines fill up the remaining lines
+    p = BrickLines()
+    while len(p.instructions) + 10 <= num_lines:
+        p.append(BrickInstructionRepeat(2))
+        p.append(BrickInstructionSetOutput("motor on", 0x15, 0.1))
+        p.append(BrickInstructionIf(True, None))
+        p.append(BrickInstructionSetOutput("lamp", 0x2A, 0.1))
+        p.append(BrickInstructionEndif())
+        p.append(BrickInstructionSetOutput("both", 0x01, 0.2))
+        p.append(BrickInstructionIf(None, False))
+        p.append(BrickInstructionSetOutput("never", 0x02, 0.1))
+        p.append(BrickInstructionEndif())
+        p.append(BrickInstructionEndrepeat())
+    while len(p.instructions) < num_lines:
+        p.append(BrickInstructionSetOutput("pad", len(p.instructions) & 0x3F, 0.5))
+    return p
+
+
+class StepCounter(BrickObserver):
+    def __init__(self):
+        self.steps = 0
+
+    def on_line(self, line_no):
+        self.steps += 1
+
+
+def measure(function, min_time, min_repeat=5, min_batch_time=0.001):
+    # best time of a call; the minimum is the least disturbed by other processes (and, like timeit, without
+    # garbage collection in between); short calls are measured in batches to overcome the timer resolution
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        number = 1
+        while True:
+            start = perf_counter()
+            for _ in range(number):
+                function()
+            duration = perf_counter() - start
+            if duration >= min_batch_time:
+                break
+            number *= 10
+        best = duration
+        total = duration
+        repeat = 1
+        while (repeat < min_repeat) or (total < min_time):
+            start = perf_counter()
+            for _ in range(number):
+                function()
+            duration = perf_counter() - start
+            total += duration
+            repeat += 1
+            best = min(best, duration)
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return best / number
+
+
+def result(seconds, items, unit):
+    return {'seconds': seconds, 'items': items, 'unit': unit, 'rate': items / seconds if seconds else 0}
+
+
+def parse_files(file_format, filenames):
+    def parse():
+        for filename in filenames:
+            p = BrickLines()
+            if file_format == BrickFileFormat.COMMODORE:
+                p.from_file_commodore(filename)
+            else:
+                p.from_file_apple(filename)
+    return parse
+
+
+def count_lines(filenames):
+    lines = 0
+    for filename in filenames:
+        p = BrickLines()
+        p.from_file(filename)
+        lines += len(p.instructions)
+    return lines
+
+
+def run_program(p):
+    def run():
+        p.simulate()
+        p.run(headless=True)
+    return run
+
+
+def run_python(*args):
+    # with the byte code cache as in normal use (written by the first run)
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    command = [sys.executable] + list(args)
+    directory = os.path.dirname(os.path.abspath(__file__))
+
+    def run():
+        return subprocess.run(command, env=env, cwd=directory, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                              text=True, check=True)
+    return run
+
+
+def import_time(min_time, module, min_repeat=5):
+    # best import time of a module in a fresh interpreter as reported by -X importtime (cumulative microseconds
+    # per module on stderr); unlike the difference of two process runs this cannot drop to or below zero
+    run = run_python('-X', 'importtime', '-c', f"import {module}")
+    run()
+    best = None
+    total = 0
+    repeat = 0
+    while (repeat < min_repeat) or (total < min_time):
+        start = perf_counter()
+        output = run().stderr
+        total += perf_counter() - start
+        repeat += 1
+        for line in output.splitlines():
+            fields = line.split('|')
+            if (len(fields) == 3) and (fields[2].strip() == module):
+                seconds = int(fields[1]) / 1000000
+                best = seconds if best is None else min(best, seconds)
+    assert best is not None, f"No import time reported for {module}"
+    return result(best, 1, 'starts')
+
+
+def startup(min_time, *args):
+    # time beyond starting the bare interpreter, measured in turns; not clamped, noise shows up as it is
+    bare = run_python('-c', 'pass')
+    run = run_python(*args)
+    run()
+    return result(measure(run, min_time) - measure(bare, min_time), 1, 'starts')
+
+
+def benchmarks(sizes, corpus_directory, work_directory):
+    # yields (name, function returning the result); the functions take the minimum measuring time
+    yield "startup/import", lambda t: import_time(t, 'brick_lines')
+    directory = os.path.join(corpus_directory, 'commodore')
+    example = os.path.join(directory, sorted(os.listdir(directory))[0])
+    yield "startup/print", lambda t: startup(t, '-m', 'brick_lines', '-f', example)
+
+    for name, file_format in (('apple', BrickFileFormat.APPLE_II), ('commodore', BrickFileFormat.COMMODORE)):
+        directory = os.path.join(corpus_directory, name)
+        filenames = sorted(os.path.join(directory, f) for f in os.listdir(directory))
+        yield f"parse_{name}/corpus", lambda t, f=file_format, n=filenames: \
+            result(measure(parse_files(f, n), t), count_lines(n), 'lines')
+
+    for num_lines in sizes:
+        p = synthetic_program(num_lines)
+        for name, file_format in (('apple', BrickFileFormat.APPLE_II), ('commodore', BrickFileFormat.COMMODORE)):
+            if (file_format == BrickFileFormat.COMMODORE) and (num_lines > COMMODORE_LINES_MAX):
+                continue
+            filename = os.path.join(work_directory, f"synthetic_{num_lines}{FILE_EXTENSIONS[file_format]}")
+            p.to_file(filename, file_format)
+            yield f"parse_{name}/synthetic_{num_lines}", lambda t, f=file_format, n=filename, lines=num_lines: \
+                result(measure(parse_files(f, [n]), t), lines, 'lines')
+
+        yield f"check/synthetic_{num_lines}", lambda t, p=p, lines=num_lines: \
+            result(measure(p.check, t), lines, 'lines')
+
+        def run(t, p=p):
+            # number of steps from one counted run, the measured runs are without any observers
+            counter = StepCounter()
+            p.simulate()
+            p.run(headless=True, observers=[counter])
+            return result(measure(run_program(p), t), counter.steps, 'steps')
+        yield f"run/synthetic_{num_lines}", run
+
+        # rendering one step: the whole program with the active line highlighted
+        yield f"show/synthetic_{num_lines}", lambda t, p=p: \
+            result(measure(lambda: p.show(len(p.instructions) // 2), t), 1, 'steps')
+
+        def render(t, p=p):
+            with open(os.devnull, "w") as null, redirect_stdout(null):
+                return result(measure(lambda: p.print(len(p.instructions) // 2), t), 1, 'steps')
+        yield f"print/synthetic_{num_lines}", render
+
+
+def compare(results, baseline, tolerance):
+    # returns the names of the benchmarks which became slower than the baseline by more than the tolerance
+    regressions = []
+    for name, r in results.items():
+        b = baseline.get(name)
+        if (b is None) or (b['seconds'] <= 0):
+            # no relative change against a zero baseline (e.g. startup times of older results)
+            continue
+        change = r['seconds'] / b['seconds'] - 1
+        r['baseline_seconds'] = b['seconds']
+        r['change'] = change
+        if change > tolerance:
+            regressions.append(name)
+    return regressions
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="BRICK Lines benchmarks (no hardware needed)")
+    parser.add_argument("-o", "--output",
+                        help="Write the results as JSON into a file instead of printing them")
+    parser.add_argument("--baseline",
+                        help="JSON results of an earlier run to compare with; exits with status 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Slowdown against the baseline accepted before reporting a regression (default: 0.25)")
+    parser.add_argument("--quick", action="store_true",
+                        help="Only synthetic programs up to 1000 lines")
+    parser.add_argument("--min-time", type=float, default=0.5,
+                        help="Minimum measuring time per benchmark in seconds (default: 0.5)")
+    parser.add_argument("-k", "--filter",
+                        help="Only run the benchmarks whose names contain the given text")
+    parser.add_argument("--corpus", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples"),
+                        help="Directory with the apple and commodore subdirectories of save files")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        assert baseline.get('format') == RESULTS_FORMAT, "Unsupported format of the baseline"
+
+    results = {}
+    with tempfile.TemporaryDirectory() as work_directory:
+        for name, benchmark in benchmarks(QUICK_SIZES if args.quick else SIZES, args.corpus, work_directory):
+            if (args.filter is not None) and (args.filter not in name):
+                continue
+            r = benchmark(args.min_time)
+            results[name] = r
+            # progress on stderr, stdout may be the JSON results
+            print(f"{name:<32}{r['seconds'] * 1000:12.3f} ms  {r['rate']:14.0f} {r['unit']}/s", file=sys.stderr)
+
+    regressions = []
+    for name, budget in STARTUP_BUDGETS.items():
+        if (name in results) and (results[name]['seconds'] > budget):
+            print(f"{name} exceeds its budget of {budget * 1000:g} ms", file=sys.stderr)
+            regressions.append(name)
+    if baseline is not None:
+        regressions += [name for name in compare(results, baseline['results'], args.tolerance)
+                        if name not in regressions]
+        print(file=sys.stderr)
+        for name, r in results.items():
+            if 'change' in r:
+                mark = "  REGRESSION" if name in regressions else ""
+                print(f"{name:<32}{r['change'] * 100:+8.1f} % against the baseline{mark}", file=sys.stderr)
+
+    report = {'format': RESULTS_FORMAT, 'time': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+              'python': platform.python_version(), 'platform': platform.platform(), 'min_time': args.min_time,
+              'results': results, 'regressions': regressions}
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    sys.exit(1 if regressions else 0)
@@ -14,12 +14,49 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os.path
-from colorama import init as colorama_init, Fore, Back, Style
-from time import sleep
+# only what every script needs is imported here; everything else (colorama, pyserial, asyncio, threading, ...)
+# is imported where it is needed, so that scripts which only load, check or print programs start fast
+from bisect import bisect_left
 from enum import Enum
+from math import ceil
+import os.path
+import struct
+import sys
+from time import sleep, monotonic, perf_counter
+
+# escape sequences to highlight the active line; same as colorama's Back.WHITE + Fore.BLACK and Style.RESET_ALL
+HIGHLIGHT = '\033[47m\033[30m'
+RESET = '\033[0m'
+terminal_initialized = False
+
+
+def init_terminal():
+    # colorama translates (or strips) the escape sequences where the terminal does not support them, e.g. on Windows
+    # or when the output is redirected; only needed once something is shown in the terminal
+    global terminal_initialized
+    if not terminal_initialized:
+        from colorama import init as colorama_init
+        colorama_init()
+        terminal_initialized = True
+
+
+# modules loaded on first use into the module's namespace (without placeholders, which a star import would export
+# over the importer's own modules): threading for connections (the serial lock), the poller, the renderer, the
+# daemon, reloading and serving metrics, socket only for the daemon and its clients and numpy (optional, it takes
+# longer to import than everything else together) only for BrickScenarioExplorer
+def init_threading():
+    global threading
+    import threading
 
-colorama_init()
+
+def init_socket():
+    global socket
+    import socket
+
+
+def init_numpy():
+    global np
+    import numpy as np
 
 
 class BrickFileFormat(Enum):
@@ -28,7 +65,36 @@ class BrickFileFormat(Enum):
     APPLE_II = 3
 
 
+# file name extensions used for the save files (also see examples/)
+FILE_EXTENSIONS = {BrickFileFormat.COMMODORE: '.lin', BrickFileFormat.APPLE_II: '.txt'}
+# maximum length of the labels (Apple ][ save files only store the labels of output lines)
+LABEL_LENGTHS_MAX = {BrickFileFormat.COMMODORE: 12, BrickFileFormat.APPLE_II: 9}
+
+# Commodore save files have a fixed length
+COMMODORE_RECORD_LENGTH = 762
+COMMODORE_ZEROS = memoryview(bytes(COMMODORE_RECORD_LENGTH))  # compared in place, without copying
+
+
+# opcodes of a compiled program, see BrickLines.compile()
+OP_SET_OUTPUT = 0
+OP_REPEAT = 1
+OP_UNTIL = 2
+OP_ENDREPEAT = 3
+OP_FOREVER = 4
+OP_IF = 5
+OP_ENDIF = 6
+OP_COUNT = 7
+
+
+class BrickEdge(Enum):
+    RISING = 1
+    FALLING = 2
+    BOTH = 3
+
+
 class BrickInstruction:
+    __slots__ = ('label', 'in7_condition', 'in6_condition', 'out_bit_pattern', 'value')
+
     def __init__(self, label, in7_condition, in6_condition, out_bit_pattern, value):
         self.label = label
         self.in7_condition = in7_condition
@@ -71,21 +137,29 @@ class BrickInstruction:
 
 
 class BrickInstructionSetOutput(BrickInstruction):
+    __slots__ = ()
+
     def __init__(self, label, out_bit_pattern, value=None):
         super().__init__(label, None, None, out_bit_pattern, value)
 
 
 class BrickInstructionRepeat(BrickInstruction):
+    __slots__ = ()
+
     def __init__(self, value=None):
         super().__init__("REPEAT", None, None, None, value)
 
 
 class BrickInstructionRepeatEnd(BrickInstruction):
+    __slots__ = ()
+
     def __init__(self, label, in7_condition, in6_condition):
         super().__init__(label, in7_condition, in6_condition, None, None)
 
 
 class BrickInstructionUntil(BrickInstructionRepeatEnd):
+    __slots__ = ()
+
     def __init__(self, in7_condition, in6_condition):
         assert (in7_condition is not None) or (
                     in6_condition is not None), ("No real condition present, cannot accept any value for "
@@ -94,26 +168,36 @@ class BrickInstructionUntil(BrickInstructionRepeatEnd):
 
 
 class BrickInstructionEndrepeat(BrickInstructionRepeatEnd):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__("ENDREPEAT", None, None)
 
 
 class BrickInstructionForever(BrickInstructionRepeatEnd):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__("FOREVER", None, None)
 
 
 class BrickInstructionIf(BrickInstruction):
+    __slots__ = ()
+
     def __init__(self, in7_condition, in6_condition):
         super().__init__("IF", in7_condition, in6_condition, None, None)
 
 
 class BrickInstructionEndif(BrickInstruction):
+    __slots__ = ()
+
     def __init__(self):
         super().__init__("ENDIF", None, None, None, None)
 
 
 class BrickInstructionCount(BrickInstruction):
+    __slots__ = ()
+
     def __init__(self, in7_condition, in6_condition, count):
         assert (in7_condition is not None) or (
                     in6_condition is not None), ("No real condition present, cannot accept any value for "
@@ -121,115 +205,1127 @@ class BrickInstructionCount(BrickInstruction):
         super().__init__("COUNT", in7_condition, in6_condition, None, count)
 
 
+INSTRUCTION_OPCODES = {
+    BrickInstructionSetOutput: OP_SET_OUTPUT,
+    BrickInstructionRepeat: OP_REPEAT,
+    BrickInstructionUntil: OP_UNTIL,
+    BrickInstructionEndrepeat: OP_ENDREPEAT,
+    BrickInstructionForever: OP_FOREVER,
+    BrickInstructionIf: OP_IF,
+    BrickInstructionEndif: OP_ENDIF,
+    BrickInstructionCount: OP_COUNT,
+}
+OPCODE_INSTRUCTIONS = {op: cls for cls, op in INSTRUCTION_OPCODES.items()}
+
+# conditions are packed into two bits per input: 0 = any value, 1 = False, 2 = True; IN7 in bits 3..2, IN6 in bits 1..0
+CONDITION_VALUES = (None, False, True)
+PACKED_CONDITIONS = tuple((CONDITION_VALUES[c >> 2], CONDITION_VALUES[c & 0x3]) if c & 0x3 < 3 else None
+                          for c in range(12))
+
+
+def pack_condition(in7_condition, in6_condition):
+    return (CONDITION_VALUES.index(in7_condition) << 2) | CONDITION_VALUES.index(in6_condition)
+
+
+# bytecode image for the Lines executor running on the Arduino (see hardware/lines_executor): a header with magic,
+# version, COUNT edge selection (BrickEdge value), number of lines and COUNT debounce time (in microseconds), followed
+# by one record per line with opcode, operand (output bit pattern or packed condition), jump target and argument
+# (wait time in microseconds, REPEAT count or number of changes to COUNT); all little endian
+BYTECODE_MAGIC = b'BLBC'
+BYTECODE_VERSION = 1
+BYTECODE_HEADER = struct.Struct('<4sBBHI')
+BYTECODE_RECORD = struct.Struct('<BBHI')
+
+
+class BrickPackedProgram:
+    # compact struct-of-arrays representation of a program: the n-th element of each array belongs to line n;
+    # converts losslessly from and to the instruction classes and serializes to bytes without any per-line objects
+    magic = b'BLPP'
+    header = struct.Struct('<4sI')  # magic, number of lines
+    value_types = (type(None), int, float)
+
+    def __init__(self):
+        from array import array
+
+        self.opcodes = array('B')
+        self.conditions = array('B')  # see pack_condition()
+        self.out_bit_patterns = array('h')  # -1: none
+        self.value_kinds = array('B')  # index into value_types
+        self.values = array('d')
+        self.targets = array('i')  # jump targets, see link(); -1: none
+        self.labels = []
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    @classmethod
+    def from_instructions(cls, instructions):
+        p = cls()
+        for i in instructions:
+            p.append(i)
+        return p
+
+    def append(self, i):
+        self.opcodes.append(BrickLines.opcode(i))
+        self.conditions.append(pack_condition(i.in7_condition, i.in6_condition))
+        self.out_bit_patterns.append(-1 if i.out_bit_pattern is None else i.out_bit_pattern)
+        self.value_kinds.append(self.value_types.index(type(i.value)))
+        self.values.append(0 if i.value is None else i.value)
+        self.targets.append(-1)
+        self.labels.append(i.label)
+
+    def condition(self, line_no):
+        # tuple (in7_condition, in6_condition)
+        return PACKED_CONDITIONS[self.conditions[line_no]]
+
+    def value(self, line_no):
+        value_type = self.value_kinds[line_no]
+        if value_type == 0:
+            return None
+        elif value_type == 1:
+            return int(self.values[line_no])
+        return self.values[line_no]
+
+    def out_bit_pattern(self, line_no):
+        out_bit_pattern = self.out_bit_patterns[line_no]
+        return None if out_bit_pattern < 0 else out_bit_pattern
+
+    def instruction(self, line_no):
+        # the instructions have been validated before being packed, so skip the constructors
+        i = object.__new__(OPCODE_INSTRUCTIONS[self.opcodes[line_no]])
+        in7_condition, in6_condition = self.condition(line_no)
+        BrickInstruction.__init__(i, self.labels[line_no], in7_condition, in6_condition,
+                                  self.out_bit_pattern(line_no), self.value(line_no))
+        return i
+
+    def to_instructions(self):
+        return [self.instruction(line_no) for line_no in range(len(self))]
+
+    def link(self):
+        # resolve the jump targets: loop ends jump to the line of their loop head, an IF jumps to its ENDIF;
+        # expects the program to be properly nested (see BrickLines.check())
+        heads = []
+        for line_no, op in enumerate(self.opcodes):
+            self.targets[line_no] = -1
+            if op in (OP_REPEAT, OP_IF):
+                heads.append(line_no)
+            elif op in (OP_UNTIL, OP_ENDREPEAT, OP_FOREVER):
+                self.targets[line_no] = heads.pop()
+            elif op == OP_ENDIF:
+                self.targets[heads.pop()] = line_no
+        return self
+
+    def to_bytes(self):
+        labels = bytearray()
+        for label in self.labels:
+            encoded_label = label.encode('latin-1')
+            labels += bytes((len(encoded_label),)) + encoded_label
+        return b''.join((self.header.pack(self.magic, len(self)), self.opcodes.tobytes(),
+                         self.conditions.tobytes(), self.out_bit_patterns.tobytes(), self.value_kinds.tobytes(),
+                         self.values.tobytes(), bytes(labels)))
+
+    @classmethod
+    def from_bytes(cls, data):
+        from array import array
+
+        magic, num_lines = cls.header.unpack_from(data)
+        assert magic == cls.magic, "Not a packed program"
+        p = cls()
+        offset = cls.header.size
+        for a in (p.opcodes, p.conditions, p.out_bit_patterns, p.value_kinds, p.values):
+            size = num_lines * a.itemsize
+            assert offset + size <= len(data), "Packed program too short"
+            a.frombytes(data[offset: offset + size])
+            offset += size
+        for _ in range(num_lines):
+            assert offset < len(data), "Packed program too short"
+            label_length = data[offset]
+            p.labels.append(data[offset + 1: offset + 1 + label_length].decode('latin-1'))
+            offset += 1 + label_length
+        assert offset == len(data), "Unexpected length of packed program"
+        p.targets = array('i', [-1]) * num_lines
+        return p
+
+
+class BrickClock:
+    # wall clock used to time the execution of a program
+
+    @staticmethod
+    def now():
+        return monotonic()
+
+    @staticmethod
+    def sleep(duration):
+        sleep(duration)
+
+    @staticmethod
+    def sleep_until(deadline, spin_time=0):
+        # sleep until shortly before the deadline and busy wait for the last spin_time seconds,
+        # as sleeping alone may oversleep by several milliseconds
+        remaining = deadline - monotonic()
+        if remaining > spin_time:
+            sleep(remaining - spin_time)
+        while monotonic() < deadline:
+            pass
+
+    @staticmethod
+    async def sleep_until_async(deadline):
+        import asyncio
+        await asyncio.sleep(max(0, deadline - monotonic()))
+
+
+class BrickVirtualClock:
+    # clock which does not really wait but fast-forwards the time instead; used for simulations
+
+    def __init__(self, start_time=0):
+        self.time = start_time
+
+    def now(self):
+        return self.time
+
+    def sleep(self, duration):
+        self.time += duration
+
+    def sleep_until(self, deadline, spin_time=0):
+        self.time = max(self.time, deadline)
+
+    async def sleep_until_async(self, deadline):
+        import asyncio
+        self.time = max(self.time, deadline)
+        # still give other tasks a chance to run
+        await asyncio.sleep(0)
+
+
+class BrickTimingStatistics:
+    # measured timing of the waits after setting the outputs: jitter is how late a wait ended compared to its
+    # deadline, drift is how far the latest wait ended behind the ideal timeline
+
+    def __init__(self):
+        self.waits = 0
+        self.jitter_sum = 0
+        self.jitter_max = 0
+        self.drift = 0
+        self.resyncs = 0
+
+    def add(self, lateness):
+        self.waits += 1
+        self.jitter_sum += lateness
+        self.jitter_max = max(self.jitter_max, lateness)
+        self.drift = lateness
+
+    def statistics(self):
+        return {'waits': self.waits, 'jitter_mean': self.jitter_sum / self.waits if self.waits else 0,
+                'jitter_max': self.jitter_max, 'drift': self.drift, 'resyncs': self.resyncs}
+
+
+class BrickSimulatedInterface:
+    # software stand-in for the Arduino sketch attached to Interface A (see hardware/serial2parallel_converter);
+    # mimics the subset of pyserial's API used by BrickLines: every byte written sets the outputs and is answered
+    # with one byte holding IN7 and IN6 in bits 7 and 6 and the echoed output bits 5..0
+
+    def __init__(self, clock=None, input_trace=None, round_trip_time=0.001):
+        self.clock = clock if clock is not None else BrickVirtualClock()
+        # input trace: list of tuples (time, in7, in6), sorted by time; the inputs keep their values from the
+        # time of an entry until the time of the next entry
+        self.input_trace = list(input_trace) if input_trace is not None else []
+        # without any trace, inputs are open which reads as True (pull-ups of the Arduino)
+        self.in7 = True
+        self.in6 = True
+        self.trace_index = 0
+        # time a serial transaction takes; advances a virtual clock so that polling loops see time pass
+        self.round_trip_time = round_trip_time
+        self.timeout = None
+        self.out_bit_pattern = 0
+        self.output_log = []  # list of tuples (time, out bit pattern)
+        self.rx_buffer = bytearray()
+
+    def set_inputs(self, in7, in6):
+        self.in7 = in7
+        self.in6 = in6
+
+    def update_inputs(self):
+        now = self.clock.now()
+        while self.trace_index < len(self.input_trace) and self.input_trace[self.trace_index][0] <= now:
+            _, self.in7, self.in6 = self.input_trace[self.trace_index]
+            self.trace_index += 1
+
+    def write(self, data):
+        self.update_inputs()
+        for b in data:
+            outputs = b & 0x3F
+            if outputs != self.out_bit_pattern or not self.output_log:
+                self.output_log.append((self.clock.now(), outputs))
+            self.out_bit_pattern = outputs
+            self.rx_buffer.append((self.in7 << 7) | (self.in6 << 6) | outputs)
+        return len(data)
+
+    def read(self, size=1):
+        if len(self.rx_buffer) < size:
+            # nothing to answer; a real serial port would run into its timeout
+            assert self.timeout is not None, "Reading from the simulated interface would block forever"
+            self.clock.sleep(self.timeout)
+            size = len(self.rx_buffer)
+        elif isinstance(self.clock, BrickVirtualClock):
+            self.clock.sleep(self.round_trip_time)
+        rx = bytes(self.rx_buffer[:size])
+        del self.rx_buffer[:size]
+        return rx
+
+    @property
+    def in_waiting(self):
+        return len(self.rx_buffer)
+
+    def reset_input_buffer(self):
+        self.rx_buffer.clear()
+
+    def reset_output_buffer(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class BrickBytecodeEmulator:
+    # host-side reference of the Lines executor sketch (see hardware/lines_executor): executes a bytecode image
+    # (see BrickLines.to_bytecode()) like the Arduino does, on virtual time in microseconds; the inputs follow a trace
+    # of tuples (time, in7, in6) with times in seconds since the start of the program, COUNT samples infinitely fast
+    resync_threshold = 50000  # microseconds, same as BrickLines.resync_threshold
+
+    def __init__(self, image, input_trace=None, line_time=0):
+        magic, version, edge, num_lines, debounce = BYTECODE_HEADER.unpack_from(image)
+        assert magic == BYTECODE_MAGIC, "Not a bytecode image"
+        assert version == BYTECODE_VERSION, "Unsupported bytecode version"
+        self.edge = BrickEdge(edge)
+        self.debounce = debounce
+        self.records = [BYTECODE_RECORD.unpack_from(image, BYTECODE_HEADER.size + line_no * BYTECODE_RECORD.size)
+                        for line_no in range(num_lines)]
+        self.input_trace = [(round(t * 1000000), in7, in6) for t, in7, in6 in input_trace or []]
+        self.line_time = line_time  # microseconds each executed line takes
+        # loops which only read the inputs (no waits, no COUNT) repeat identically until the inputs change
+        self.idle_loops = set()
+        for line_no, (op, _, target, _) in enumerate(self.records):
+            if op in (OP_UNTIL, OP_FOREVER) and \
+                    all(not ((o == OP_SET_OUTPUT and a > 0) or o == OP_COUNT) for o, _, _, a in
+                        self.records[target: line_no]):
+                self.idle_loops.add(line_no)
+        self.time = 0
+        self.in7 = True
+        self.in6 = True
+        self.trace_index = 0
+        self.out_bit_pattern = 0
+        self.output_log = [(0, 0)]  # list of tuples (time in seconds, out bit pattern)
+        self.steps = 0
+        self.finished = False
+        self.error = None
+
+    def update_inputs(self):
+        while self.trace_index < len(self.input_trace) and self.input_trace[self.trace_index][0] <= self.time:
+            _, self.in7, self.in6 = self.input_trace[self.trace_index]
+            self.trace_index += 1
+        return self.in7, self.in6
+
+    def next_change_time(self):
+        if self.trace_index < len(self.input_trace):
+            return self.input_trace[self.trace_index][0]
+        return None
+
+    def check_inputs(self, condition):
+        in7_condition, in6_condition = PACKED_CONDITIONS[condition]
+        return BrickLines.evaluate_condition(in7_condition, in6_condition, *self.update_inputs())
+
+    def wait_for_input_change(self):
+        # fast-forward an idle loop; False if the inputs never change again
+        next_time = self.next_change_time()
+        if next_time is None:
+            return False
+        self.time = max(self.time, next_time)
+        return True
+
+    def count(self, condition, count):
+        in7_condition, in6_condition = PACKED_CONDITIONS[condition]
+        counter = BrickEdgeCounter(in7_condition, in6_condition, self.edge, self.debounce)
+        counter.feed(self.time, *self.update_inputs())
+        while counter.edges < count:
+            # next point in time when a sample can make a difference: an input change or the end of a lockout
+            candidates = [self.next_change_time()]
+            for index, level in enumerate(self.update_inputs()):
+                if counter.watch[index] and (level != counter.levels[index]) and \
+                        (counter.last_edge_times[index] is not None):
+                    candidates.append(counter.last_edge_times[index] + self.debounce)
+            candidates = [t for t in candidates if t is not None]
+            if not candidates:
+                return False
+            self.time = max(self.time, min(candidates))
+            counter.feed(self.time, *self.update_inputs())
+        return True
+
+    def run(self, max_steps=100000, max_time=3600):
+        # returns the output log; stops with an error message in 'error' after max_steps lines, max_time seconds or
+        # when waiting for input changes after the end of the trace
+        records = self.records
+        counters = [0] * len(records)
+        deadline = None
+        line_no = 0
+        last_line_no = None
+        while line_no < len(records):
+            self.steps += 1
+            if self.steps > max_steps:
+                self.error = "Maximum number of steps exceeded"
+                return self.output_log
+            if self.time > max_time * 1000000:
+                self.error = "Maximum run time exceeded"
+                return self.output_log
+            self.time += self.line_time
+            op, operand, target, argument = records[line_no]
+            next_line_no = line_no + 1
+            if op == OP_SET_OUTPUT:
+                if (deadline is None) or (self.time - deadline > self.resync_threshold):
+                    deadline = self.time
+                if operand != self.out_bit_pattern:
+                    self.out_bit_pattern = operand
+                    self.output_log.append((self.time / 1000000, operand))
+                deadline += argument
+                self.time = max(self.time, deadline)
+            elif op == OP_REPEAT:
+                if (last_line_no is None) or (last_line_no < line_no):
+                    counters[line_no] = 0
+            elif op == OP_UNTIL:
+                if not self.check_inputs(operand):
+                    if (line_no in self.idle_loops) and not self.wait_for_input_change():
+                        self.error = "Waiting for input changes after the end of the input trace"
+                        return self.output_log
+                    counters[target] += 1
+                    next_line_no = target
+            elif op == OP_ENDREPEAT:
+                if counters[target] + 1 < records[target][3]:
+                    counters[target] += 1
+                    next_line_no = target
+            elif op == OP_FOREVER:
+                if (line_no in self.idle_loops) and not self.wait_for_input_change():
+                    self.error = "Waiting for input changes after the end of the input trace"
+                    return self.output_log
+                counters[target] += 1
+                next_line_no = target
+            elif op == OP_IF:
+                if not self.check_inputs(operand):
+                    next_line_no = target
+            elif op == OP_COUNT:
+                if not self.count(operand, argument):
+                    self.error = "Waiting for input changes after the end of the input trace"
+                    return self.output_log
+            last_line_no = line_no
+            line_no = next_line_no
+        self.finished = True
+        return self.output_log
+
+
+# states of the scenarios of BrickScenarioExplorer
+SCENARIO_RUNNING = 0
+SCENARIO_FINISHED = 1  # end of the program reached
+SCENARIO_WAITING = 2  # waiting for input changes after the end of the scenario
+SCENARIO_TIME_LIMIT = 3
+SCENARIO_STEP_LIMIT = 4
+SCENARIO_STATES = ('running', 'finished', 'waiting', 'time limit', 'step limit')
+
+
+class BrickScenarioExplorer:
+    # executes a program against many input scenarios at once, as a batched state machine over arrays of line
+    # numbers, loop counters and outputs (needs numpy); same semantics as BrickBytecodeEmulator: virtual time in
+    # microseconds, COUNT samples infinitely fast; a scenario is a sequence of input values (IN7 in bit 1, IN6 in
+    # bit 0) each lasting step_time seconds, the last one forever; scenarios end with the program, after max_time
+    # seconds (default: one step after the end of the sequences), after max_steps lines or when waiting for input
+    # changes which do not come anymore
+    resync_threshold = BrickBytecodeEmulator.resync_threshold
+
+    def __init__(self, program, scenarios, step_time=1, max_time=None, max_steps=100000):
+        init_numpy()
+        program.check()
+        emulator = BrickBytecodeEmulator(program.to_bytecode())
+        records = np.array(emulator.records, dtype=np.int64).reshape(-1, 4)
+        self.ops, self.operands, self.targets, self.arguments = records.T
+        self.num_lines = len(records)
+        self.idle_loops = np.zeros(self.num_lines, dtype=bool)
+        self.idle_loops[sorted(emulator.idle_loops)] = True
+        self.edge = emulator.edge.value
+        self.debounce = emulator.debounce
+        self.scenarios = np.asarray(scenarios, dtype=np.uint8)
+        assert (self.scenarios.ndim == 2) and (self.scenarios.shape[1] > 0), "Scenarios need at least one step"
+        num_scenarios, num_steps = self.scenarios.shape
+        self.step_time = step_time
+        self.step = round(step_time * 1000000)
+        assert self.step > 0, "Step time too short"
+        if max_time is None:
+            max_time = (num_steps + 1) * step_time
+        self.max_time = round(max_time * 1000000)
+        self.max_steps = max_steps
+        # index of the next step with other input values than the step before, num_steps if there is none
+        changes = np.where(self.scenarios[:, 1:] != self.scenarios[:, :-1], np.arange(1, num_steps), num_steps)
+        self.next_changes = np.full((num_scenarios, num_steps), num_steps, dtype=np.int64)
+        self.next_changes[:, :-1] = np.minimum.accumulate(changes[:, ::-1], axis=1)[:, ::-1]
+
+        # state of each scenario
+        self.state = np.full(num_scenarios, SCENARIO_RUNNING, dtype=np.int8)
+        self.line_no = np.zeros(num_scenarios, dtype=np.int64)
+        self.last_line_no = np.full(num_scenarios, -1, dtype=np.int64)  # -1: none
+        self.time = np.zeros(num_scenarios, dtype=np.int64)
+        self.deadline = np.full(num_scenarios, -1, dtype=np.int64)  # -1: none
+        self.out_bit_pattern = np.zeros(num_scenarios, dtype=np.int64)
+        self.steps = np.zeros(num_scenarios, dtype=np.int64)
+        self.loop_counters = np.zeros((num_scenarios, max(self.num_lines, 1)), dtype=np.int64)
+        # state of a COUNT in progress: levels and times of the last accepted edges (-1: none) of IN7 and IN6
+        self.counting = np.zeros(num_scenarios, dtype=bool)
+        self.levels = np.zeros((2, num_scenarios), dtype=np.int64)
+        self.last_edge_times = np.full((2, num_scenarios), -1, dtype=np.int64)
+        self.edges = np.zeros(num_scenarios, dtype=np.int64)
+
+        # results: executions per line, per branching line how often it continued with the next line and how often
+        # it jumped, and the changes of the outputs as (scenario, time, out bit pattern) sorted by scenario
+        self.hits = np.zeros(self.num_lines, dtype=np.int64)
+        self.branches = np.zeros((self.num_lines, 2), dtype=np.int64)
+        self.log = []
+        self.changes = None
+
+    @staticmethod
+    def all_scenarios(num_steps):
+        # every sequence of num_steps input values, i.e. 4 ** num_steps scenarios
+        init_numpy()
+        codes = np.arange(4 ** num_steps)
+        return ((codes[:, None] >> (2 * np.arange(num_steps - 1, -1, -1))) & 3).astype(np.uint8)
+
+    @staticmethod
+    def random_scenarios(count, num_steps, seed=None):
+        init_numpy()
+        return np.random.default_rng(seed).integers(0, 4, (count, num_steps), dtype=np.uint8)
+
+    def input_trace(self, scenario):
+        # the scenario as input trace for BrickLines.simulate() or BrickBytecodeEmulator
+        return [(step * self.step_time, bool(value & 2), bool(value & 1))
+                for step, value in enumerate(self.scenarios[scenario].tolist())]
+
+    def inputs(self, scenarios):
+        step = np.minimum(self.time[scenarios] // self.step, self.scenarios.shape[1] - 1)
+        values = self.scenarios[scenarios, step].astype(np.int64)
+        return values >> 1, values & 1
+
+    def next_change_times(self, scenarios):
+        # -1 if the inputs do not change anymore
+        num_steps = self.scenarios.shape[1]
+        step = np.minimum(self.time[scenarios] // self.step, num_steps - 1)
+        next_step = self.next_changes[scenarios, step]
+        return np.where(next_step < num_steps, next_step * self.step, -1)
+
+    def check_conditions(self, scenarios, conditions):
+        in7, in6 = self.inputs(scenarios)
+        in7_condition = conditions >> 2
+        in6_condition = conditions & 0x3
+        # condition 0 accepts any value, 1 and 2 the values 0 and 1
+        return ((in7_condition == 0) | (in7 == in7_condition - 1)) & \
+            ((in6_condition == 0) | (in6 == in6_condition - 1))
+
+    def wait_for_input_changes(self, scenarios, line_nos):
+        # fast-forward the idle loops; returns which scenarios go on, the others wait for input changes forever
+        idle = self.idle_loops[line_nos]
+        next_times = self.next_change_times(scenarios[idle])
+        waiting = np.zeros(len(scenarios), dtype=bool)
+        waiting[idle] = next_times < 0
+        self.state[scenarios[waiting]] = SCENARIO_WAITING
+        fast_forward = scenarios[idle][next_times >= 0]
+        self.time[fast_forward] = np.maximum(self.time[fast_forward], next_times[next_times >= 0])
+        return ~waiting
+
+    def count_branches(self, line_nos, continued):
+        self.branches[:, 0] += np.bincount(line_nos[continued], minlength=self.num_lines)
+        self.branches[:, 1] += np.bincount(line_nos[~continued], minlength=self.num_lines)
+
+    def run(self):
+        while True:
+            active = np.flatnonzero(self.state == SCENARIO_RUNNING)
+            if len(active) == 0:
+                break
+            # scenarios in the middle of a COUNT take their next sample, the others execute their next line
+            counting = self.counting[active]
+            if counting.any():
+                self.sample(active[counting])
+            if not counting.all():
+                self.step_lines(active[~counting])
+        if self.log:
+            times, scenarios, bit_patterns = (np.concatenate(a) for a in zip(*self.log))
+        else:
+            times = scenarios = bit_patterns = np.zeros(0, dtype=np.int64)
+        order = np.argsort(scenarios, kind='stable')
+        self.changes = (scenarios[order], times[order], bit_patterns[order])
+        self.log = []
+        return self
+
+    def step_lines(self, scenarios):
+        # execute one line in each of the scenarios
+        finished = self.line_no[scenarios] >= self.num_lines
+        self.state[scenarios[finished]] = SCENARIO_FINISHED
+        scenarios = scenarios[~finished]
+        self.steps[scenarios] += 1
+        over = self.steps[scenarios] > self.max_steps
+        self.state[scenarios[over]] = SCENARIO_STEP_LIMIT
+        scenarios = scenarios[~over]
+        over = self.time[scenarios] > self.max_time
+        self.state[scenarios[over]] = SCENARIO_TIME_LIMIT
+        scenarios = scenarios[~over]
+
+        line_nos = self.line_no[scenarios]
+        self.hits += np.bincount(line_nos, minlength=self.num_lines)
+        next_line_nos = line_nos + 1
+        ops = self.ops[line_nos]
+        for op in np.unique(ops).tolist():
+            selected = np.flatnonzero(ops == op)
+            s = scenarios[selected]
+            line_no = line_nos[selected]
+            if op == OP_SET_OUTPUT:
+                time = self.time[s]
+                deadline = self.deadline[s]
+                deadline = np.where((deadline < 0) | (time - deadline > self.resync_threshold), time, deadline)
+                bit_patterns = self.operands[line_no]
+                changed = bit_patterns != self.out_bit_pattern[s]
+                self.log.append((time[changed], s[changed], bit_patterns[changed]))
+                self.out_bit_pattern[s] = bit_patterns
+                deadline += self.arguments[line_no]
+                self.deadline[s] = deadline
+                self.time[s] = np.maximum(time, deadline)
+            elif op == OP_REPEAT:
+                entering = self.last_line_no[s] < line_no
+                self.loop_counters[s[entering], line_no[entering]] = 0
+            elif op in (OP_UNTIL, OP_FOREVER):
+                if op == OP_UNTIL:
+                    met = self.check_conditions(s, self.operands[line_no])
+                    self.count_branches(line_no, met)
+                    selected, s, line_no = selected[~met], s[~met], line_no[~met]
+                going_on = self.wait_for_input_changes(s, line_no)
+                selected, s, line_no = selected[going_on], s[going_on], line_no[going_on]
+                heads = self.targets[line_no]
+                self.loop_counters[s, heads] += 1
+                next_line_nos[selected] = heads
+            elif op == OP_ENDREPEAT:
+                heads = self.targets[line_no]
+                done = self.loop_counters[s, heads] + 1 >= self.arguments[heads]
+                self.count_branches(line_no, done)
+                self.loop_counters[s[~done], heads[~done]] += 1
+                next_line_nos[selected[~done]] = heads[~done]
+            elif op == OP_IF:
+                met = self.check_conditions(s, self.operands[line_no])
+                self.count_branches(line_no, met)
+                next_line_nos[selected[~met]] = self.targets[line_no[~met]]
+            elif op == OP_COUNT:
+                # the first sample only determines the initial levels
+                self.levels[0, s], self.levels[1, s] = self.inputs(s)
+                self.last_edge_times[:, s] = -1
+                self.edges[s] = 0
+                counting = self.arguments[line_no] > 0
+                self.counting[s[counting]] = True
+                next_line_nos[selected[counting]] = line_no[counting]
+        self.last_line_no[scenarios] = line_nos
+        self.line_no[scenarios] = next_line_nos
+
+    def sample(self, scenarios):
+        # advance each COUNT in progress to the next point in time when a sample can make a difference: an input
+        # change or the end of the debounce time of an input which differs
+        conditions = self.operands[self.line_no[scenarios]]
+        watch = ((conditions >> 2) != 0, (conditions & 0x3) != 0)
+        never = np.iinfo(np.int64).max
+        next_times = self.next_change_times(scenarios)
+        next_times = np.where(next_times < 0, never, next_times)
+        for index, level in enumerate(self.inputs(scenarios)):
+            locked = watch[index] & (level != self.levels[index, scenarios]) & \
+                (self.last_edge_times[index, scenarios] >= 0)
+            next_times = np.where(locked, np.minimum(next_times, self.last_edge_times[index, scenarios] +
+                                                     self.debounce), next_times)
+        waiting = next_times == never
+        self.state[scenarios[waiting]] = SCENARIO_WAITING
+        self.counting[scenarios[waiting]] = False
+        scenarios, next_times = scenarios[~waiting], next_times[~waiting]
+        watch = (watch[0][~waiting], watch[1][~waiting])
+        time = np.maximum(self.time[scenarios], next_times)
+        self.time[scenarios] = time
+        for index, level in enumerate(self.inputs(scenarios)):
+            last_edge_times = self.last_edge_times[index, scenarios]
+            changed = watch[index] & (level != self.levels[index, scenarios])
+            bouncing = changed & (last_edge_times >= 0) & (time - last_edge_times < self.debounce)
+            accepted = changed & ~bouncing
+            self.levels[index, scenarios[accepted]] = level[accepted]
+            self.last_edge_times[index, scenarios[accepted]] = time[accepted]
+            if self.edge != BrickEdge.BOTH.value:
+                accepted &= level == (self.edge == BrickEdge.RISING.value)
+            self.edges[scenarios] += accepted
+        line_nos = self.line_no[scenarios]
+        done = self.edges[scenarios] >= self.arguments[line_nos]
+        scenarios, line_nos = scenarios[done], line_nos[done]
+        self.counting[scenarios] = False
+        self.last_line_no[scenarios] = line_nos
+        self.line_no[scenarios] = line_nos + 1
+
+    def timeline(self, scenario):
+        # list of tuples (time, out bit pattern) like the output log of BrickBytecodeEmulator
+        scenarios, times, bit_patterns = self.changes
+        start, end = np.searchsorted(scenarios, [scenario, scenario + 1])
+        return [(0, 0)] + [(t / 1000000, b) for t, b in zip(times[start:end].tolist(),
+                                                             bit_patterns[start:end].tolist())]
+
+    def coverage(self):
+        # lines (numbered from 1) never executed in any scenario and branching lines (IF, UNTIL, ENDREPEAT) which
+        # always continued with the next line or always jumped
+        branching = np.isin(self.ops, (OP_IF, OP_UNTIL, OP_ENDREPEAT))
+        one_way = branching & (self.hits > 0) & ((self.branches[:, 0] == 0) | (self.branches[:, 1] == 0))
+        return {'lines': self.num_lines, 'executed': int(np.count_nonzero(self.hits)),
+                'unexecuted': (np.flatnonzero(self.hits == 0) + 1).tolist(),
+                'branches': {line_no + 1: tuple(self.branches[line_no].tolist())
+                             for line_no in np.flatnonzero(branching).tolist()},
+                'one_way': (np.flatnonzero(one_way) + 1).tolist()}
+
+    def states(self):
+        counts = np.bincount(self.state, minlength=len(SCENARIO_STATES))
+        return {name: int(count) for name, count in zip(SCENARIO_STATES, counts) if count}
+
+    def compare(self, other):
+        # scenarios in which the outputs of two explored programs change differently (bit patterns or times) up to
+        # max_time; scenarios which ran into the step limit in either program are inconclusive instead
+        assert (self.scenarios.shape == other.scenarios.shape) and (self.step == other.step) and \
+               (self.max_time == other.max_time) and np.array_equal(self.scenarios, other.scenarios), \
+               "Programs need to be explored with the same scenarios"
+        num_scenarios = len(self.scenarios)
+        counts = np.bincount(self.changes[0], minlength=num_scenarios)
+        differing = counts != np.bincount(other.changes[0], minlength=num_scenarios)
+        # the changes of the scenarios with the same number of changes line up
+        own = ~differing[self.changes[0]]
+        others = ~differing[other.changes[0]]
+        mismatches = (self.changes[1][own] != other.changes[1][others]) | \
+                     (self.changes[2][own] != other.changes[2][others])
+        differing[self.changes[0][own][mismatches]] = True
+        inconclusive = (self.state == SCENARIO_STEP_LIMIT) | (other.state == SCENARIO_STEP_LIMIT)
+        differing &= ~inconclusive
+        return {'scenarios': num_scenarios, 'equivalent': not differing.any(),
+                'differing': np.flatnonzero(differing).tolist(), 'inconclusive': np.flatnonzero(inconclusive).tolist()}
+
+    def summary(self):
+        coverage = self.coverage()
+        num_scenarios, num_steps = self.scenarios.shape
+        r = f"{num_scenarios} scenarios of {num_steps} steps of {self.step_time:g} s: " + \
+            ", ".join(f"{count} {name}" for name, count in self.states().items()) + "\n"
+        r += f"Lines executed: {coverage['executed']} of {coverage['lines']}"
+        if coverage['unexecuted']:
+            r += "; never executed: " + ", ".join(str(line_no) for line_no in coverage['unexecuted'])
+        r += "\n"
+        for line_no, (continued, jumped) in coverage['branches'].items():
+            if continued + jumped == 0:
+                continue  # never executed
+            r += f"  line {line_no:>3}: {continued:>10} times to the next line, {jumped:>10} times jumped"
+            r += "  (one way only)\n" if line_no in coverage['one_way'] else "\n"
+        return r
+
+    def show_scenario(self, scenario):
+        # input values (IN7 and IN6) per step
+        return " ".join(f"{value >> 1}{value & 1}" for value in self.scenarios[scenario].tolist())
+
+    def show_timeline(self, scenario):
+        return " ".join(f"{t:g}s:{bit_pattern:06b}" for t, bit_pattern in self.timeline(scenario))
+
+
+# increment whenever parsing save files changes its results, so that cached programs get invalidated
+PARSER_VERSION = 3
+
+
+class BrickProgramCache:
+    # on-disk cache of parsed programs (instructions and the keyword style of Apple ][ save files) in a compact
+    # binary form, keyed by a hash of the file content, the file format and the parser version; the least recently
+    # used entries are evicted; recently used entries are additionally kept in memory
+    eviction_batch = 0.125  # share of max_entries evicted at once, so that not every store scans the directory
+
+    def __init__(self, directory=None, max_entries=4096, max_memory_entries=256):
+        if directory is None:
+            directory = os.environ.get('BRICK_LINES_CACHE',
+                                       os.path.join(os.path.expanduser('~'), '.cache', 'brick_lines'))
+        self.directory = directory
+        self.max_entries = max_entries
+        # counted once, then tracked; other processes sharing the directory are only noticed by the next eviction
+        self.num_entries = None
+        from collections import OrderedDict
+        self.memory = OrderedDict()
+        self.max_memory_entries = max_memory_entries
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(content, file_format):
+        import hashlib
+        h = hashlib.sha256(f"{PARSER_VERSION}:{file_format.name}:".encode('ascii'))
+        h.update(content)
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.blpc')
+
+    def remember(self, key, data):
+        self.memory[key] = data
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_memory_entries:
+            self.memory.popitem(last=False)
+
+    def load(self, key):
+        data = self.memory.get(key)
+        if data is not None:
+            self.memory.move_to_end(key)
+        else:
+            path = self.path(key)
+            try:
+                with open(path, "rb") as file:
+                    data = file.read()
+                # mark as recently used
+                os.utime(path)
+            except OSError:
+                return None
+            self.remember(key, data)
+        try:
+            return self.decode(data)
+        except (AssertionError, struct.error, UnicodeDecodeError, IndexError, KeyError, ValueError):
+            # broken entry (e.g. truncated or overwritten), remove it and parse again
+            self.discard(key)
+            return None
+
+    def discard(self, key):
+        self.memory.pop(key, None)
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            return
+        if self.num_entries is not None:
+            self.num_entries -= 1
+
+    def store(self, key, instructions, apple_keyword_style):
+        path = self.path(key)
+        # write to a temporary file first so that concurrent readers never see partial entries
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        data = self.encode(instructions, apple_keyword_style)
+        is_new = not os.path.exists(path)
+        with open(temporary_path, "wb") as file:
+            file.write(data)
+        os.replace(temporary_path, path)
+        self.remember(key, data)
+        if self.num_entries is None:
+            self.num_entries = sum(1 for name in os.listdir(self.directory) if name.endswith('.blpc'))
+        elif is_new:
+            self.num_entries += 1
+        if self.num_entries > self.max_entries:
+            self.evict()
+
+    def evict(self):
+        # removes the least recently used entries down to max_entries less a batch
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.blpc'):
+                try:
+                    entries.append((os.path.getmtime(os.path.join(self.directory, name)), name))
+                except OSError:
+                    pass  # removed by another process in the meantime
+        self.num_entries = len(entries)
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort()
+        num_kept = self.max_entries - int(self.max_entries * self.eviction_batch)
+        for _, name in entries[:len(entries) - num_kept]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+        self.num_entries = num_kept
+
+    @staticmethod
+    def encode(instructions, apple_keyword_style):
+        # parser version, length of the keyword style, keyword style (both keywords separated by a line feed) and
+        # the packed program
+        keyword_style = '\n'.join(apple_keyword_style).encode('latin-1')
+        return PARSER_VERSION.to_bytes(2, byteorder='little') + len(keyword_style).to_bytes(2, byteorder='little') + \
+            keyword_style + BrickPackedProgram.from_instructions(instructions).to_bytes()
+
+    @staticmethod
+    def decode(data):
+        # returns a tuple (instructions, apple_keyword_style)
+        assert int.from_bytes(data[:2], byteorder='little') == PARSER_VERSION
+        length = int.from_bytes(data[2:4], byteorder='little')
+        apple_keyword_style = tuple(data[4:4 + length].decode('latin-1').split('\n'))
+        assert len(apple_keyword_style) == 2
+        return BrickPackedProgram.from_bytes(data[4 + length:]).to_instructions(), apple_keyword_style
+
+
 class BrickLines:
+    # how keywords without conditions and the outputs of keywords are displayed in Apple ][ save files
+    apple_keyword_style_default = ('HIHI', 'HIIIIIIIIIII')
+    # FIXME: wait time of lines without a value; what is it? assume 1 second for now
+    default_wait_time = 1
+
     def __init__(self):
         self.instructions = []
+        self.code = None  # packed program being executed, see compile()
+        self.apple_keyword_style = self.apple_keyword_style_default
         self.serial_connection = None
         self.last_out_bit_pattern = None
-
-    def connect(self, serial_port):
-        import serial
-
+        self.clock = BrickClock()
+        self.deadline = None
+        self.resync_threshold = 0.05  # seconds
+        self.spin_time = 0  # seconds to busy wait before a deadline for higher precision, e.g. 0.01
+        self.timing = BrickTimingStatistics()
+        self.serial_lock = None  # see open_connection()
+        self.pending_echoes = 0
+        self.echo_inputs = None  # (time, in7, in6) from the latest echo
+        self.echo_max_age = 0.005  # seconds
+        self.serial_writes = 0
+        self.skipped_writes = 0
+        self.async_poll_interval = 0.001  # seconds between checks for received bytes in asynchronous mode
+        self.poller = None
+        self.count_edge = BrickEdge.BOTH
+        self.count_debounce = 0
+        self.edge_counter = None
+        self.observers = []
+        self.output_callbacks = []
+        self.input_callbacks = []
+        self.loop_callbacks = []
+        self.line_map = None  # line numbers of the original program per executed line, see optimize()
+        self.optimization = None  # report of the latest optimize() used for running
+        self.metrics = None  # see enable_metrics()
+
+    def connect(self, serial_port, clock=None):
+        self.open_connection(serial_port, clock)
+        # turn outputs off initially (first call always seems to run into timeout);
+        # but afterward it is okay; so do it twice during connection establishment
+        self.set_outputs(0, serial_timeout=0.5)
+        self.set_outputs(0, force=True)
+
+    async def connect_async(self, serial_port, clock=None):
+        self.open_connection(serial_port, clock)
+        # same as in connect()
+        await self.set_outputs_async(0, serial_timeout=0.5)
+        await self.set_outputs_async(0, force=True)
+
+    def connect_daemon(self, address, clock=None):
+        # like connect() but sharing Interface A via a BrickDaemon (see --serve); the daemon keeps the serial
+        # connection open and warm, so there is no handshake; fails if another client owns the outputs
+        self.open_connection(BrickDaemonConnection(address), clock)
+        self.set_outputs(0, wait_time=0, force=True)
+        self.collect_echoes()
+
+    def open_connection(self, serial_port, clock=None):
+        # serial_port is either the name of a serial device or an already opened object providing pyserial's
+        # write(), read(), in_waiting and timeout, e.g. a BrickSimulatedInterface
+        self.stop_polling()
         if self.serial_connection is not None:
             self.serial_connection.close()
-
-        self.serial_connection = serial.Serial(serial_port, baudrate=19200)
+        if self.serial_lock is None:
+            # a poller or a daemon may share the connection
+            init_threading()
+            self.serial_lock = threading.RLock()
+
+        if isinstance(serial_port, str):
+            import serial
+            self.serial_connection = serial.Serial(serial_port, baudrate=19200)
+        else:
+            self.serial_connection = serial_port
+        # real time unless another clock is given, also after a simulation on virtual time
+        self.clock = clock if clock is not None else BrickClock()
         self.serial_connection.reset_input_buffer()
         self.serial_connection.reset_output_buffer()
-        # turn outputs off initially (first call always seems to run into timeout);
-        # but afterward it is okay; so do it twice during connection establishment
-        self.set_outputs(0, serial_timeout=0.5)
-        self.set_outputs(0)
+        self.last_out_bit_pattern = None
+        self.pending_echoes = 0
+        self.echo_inputs = None
+
+    def start_polling(self, rate=500, log_size=1024):
+        # sample the inputs in the background so that reading them does not block on the serial connection
+        self.stop_polling()
+        poller = BrickInputPoller(self, rate, log_size)
+        poller.start()
+        self.poller = poller
+        return poller
+
+    def stop_polling(self):
+        if self.poller is not None:
+            self.poller.stop()
+            self.poller = None
+
+    def simulate(self, input_trace=None):
+        # connect to a simulated Interface A running on virtual time; returns the simulator so that its inputs
+        # can be changed and its output_log can be inspected; the times of the input trace are relative to the
+        # end of the connection establishment
+        clock = BrickVirtualClock()
+        interface = BrickSimulatedInterface(clock)
+        self.connect(interface, clock)
+        if input_trace is not None:
+            interface.input_trace = [(clock.now() + t, in7, in6) for t, in7, in6 in input_trace]
+        return interface
+
+    def from_file(self, filename, file_format=BrickFileFormat.AUTO_DETECT, cache=None):
+        assert os.path.isfile(filename), "Invalid file path"
+        with open(filename, "rb") as file:
+            content = file.read()
+        self.from_bytes(content, file_format, cache)
 
-    def from_file(self, filename, file_format=BrickFileFormat.AUTO_DETECT):
+    def from_bytes(self, content, file_format=BrickFileFormat.AUTO_DETECT, cache=None):
+        # parse the content of a save file; with a BrickProgramCache, the parsing is skipped if the same content
+        # has been parsed before
         assert isinstance(file_format, BrickFileFormat)
         assert file_format in [BrickFileFormat.AUTO_DETECT, BrickFileFormat.COMMODORE,
                                BrickFileFormat.APPLE_II], "File format not supported"
-        assert os.path.isfile(filename), "Invalid file path"
         self.instructions = []
+        if cache is not None:
+            key = cache.key(content, file_format)
+            entry = cache.load(key)
+            if entry is not None:
+                self.instructions, self.apple_keyword_style = entry
+                return
         if file_format == BrickFileFormat.AUTO_DETECT:
-            self.from_file_auto_detect(filename)
-        elif file_format == BrickFileFormat.COMMODORE:
-            self.from_file_commodore(filename)
+            file_format = self.detect_file_format(content)
+        if file_format == BrickFileFormat.COMMODORE:
+            self.from_bytes_commodore(content)
         elif file_format == BrickFileFormat.APPLE_II:
-            self.from_file_apple(filename)
+            self.from_bytes_apple(content)
+        if cache is not None:
+            cache.store(key, self.instructions, self.apple_keyword_style)
 
-    def from_file_auto_detect(self, filename):
+    @staticmethod
+    def detect_file_format(content):
         # DOS file format is currently unknown and hence not supported (yet?)
-        is_commodore = False
+        if len(content) == COMMODORE_RECORD_LENGTH and \
+                (content[0x280:0x2D1] == b'\x00' * 0x51) and \
+                (content[0x2F9:] == b'\xff'):
+            return BrickFileFormat.COMMODORE
+        return BrickFileFormat.APPLE_II
+
+    def from_file_auto_detect(self, filename):
         with open(filename, "rb") as file:
             content = file.read()
-            if len(content) == 762 and \
-                    (content[0x280:0x2D1] == b'\x00' * 0x51) and \
-                    (content[0x2F9:] == b'\xff'):
-                is_commodore = True
-        if is_commodore:
-            self.from_file_commodore(filename)
+        if self.detect_file_format(content) == BrickFileFormat.COMMODORE:
+            self.from_bytes_commodore(content)
         else:
-            self.from_file_apple(filename)
+            self.from_bytes_apple(content)
 
     def from_file_commodore(self, filename):
-        num_llines_max = 40
+        with open(filename, "rb") as file:
+            self.from_bytes_commodore(file.read())
+
+    def from_bytes_commodore(self, content):
+        # content can be any buffer (bytes, mmap, memoryview, ...); the lines are decoded from it without copying
         lline_length = 16
         lline_label_length_max = 12
 
-        with open(filename, "rb") as file:
-            content = file.read()
-            assert len(content) == 762  # expecting a fixed length file independent of its LEGO Lines contents
-            assert content[
-                   0x280:0x2D1] == b'\x00' * 0x51  # these bytes are always zero (unused reserved part of the file?)
-            assert content[0x2F9:] == b'\xff'
-            bit_patterns = content[0x2D1:-1]
-            assert len(bit_patterns) == num_llines_max
-            # assuming that the b'\xff' bytes only come as block at the end, it's enough to simply count them!
-            num_llines_free = bit_patterns.count(b'\xff')
-            num_llines_used = num_llines_max - num_llines_free
-            # debugging info
-            # print(f"Number of llines used: {num_llines_used}")
-            # print(f"Number of llines free: {num_llines_free}")
-            # this section of the file should also be unused:
-            assert content[
-                   num_llines_used * lline_length: 0x280] == num_llines_free * lline_length * b'\x00'
-            for lline_no in range(num_llines_used):
-                lline = content[lline_no * lline_length: (lline_no + 1) * lline_length]
-                label = lline[:lline_label_length_max].rstrip(b'\x00').decode('ascii')
-                value = lline[lline_label_length_max:].rstrip(b'\x00').decode('ascii')
-                converted_value = self.convert_value(value)
-                # print only for debugging
-                # print(f"{label: <{lline_label_length_max}} {bit_patterns[lline_no]: <3} ", end="")
-                # if converted_value:
-                #    print(f"{converted_value: <4}")
-                # else:
-                #    print()
-                if label in ['REPEAT', 'UNTIL', 'ENDREPEAT', 'FOREVER', 'IF', 'ENDIF', 'COUNT']:
-                    # print("  Keyword detected!")
-                    if label == 'REPEAT':
-                        i = BrickInstructionRepeat(converted_value)
-                    elif label == 'UNTIL':
-                        in7_condition, in6_condition = self.convert_condition_commodore(bit_patterns[lline_no])
-                        i = BrickInstructionUntil(in7_condition, in6_condition)
-                    elif label == 'ENDREPEAT':
-                        i = BrickInstructionEndrepeat()
-                    elif label == 'FOREVER':
-                        i = BrickInstructionForever()
-                    elif label == 'IF':
-                        in7_condition, in6_condition = self.convert_condition_commodore(bit_patterns[lline_no])
-                        i = BrickInstructionIf(in7_condition, in6_condition)
-                    elif label == 'ENDIF':
-                        i = BrickInstructionEndif()
-                    elif label == 'COUNT':
-                        in7_condition, in6_condition = self.convert_condition_commodore(bit_patterns[lline_no])
-                        i = BrickInstructionCount(in7_condition, in6_condition, converted_value)
-                    else:
-                        assert False, "Lazy programmer forgot something"
-
+        content = memoryview(content).cast('B')
+        num_llines_used = self.check_record_commodore(content)
+        assert num_llines_used is not None, "Not a Commodore save file"
+        for lline_no in range(num_llines_used):
+            offset = lline_no * lline_length
+            label = str(content[offset: offset + lline_label_length_max], 'ascii').rstrip('\x00')
+            value = str(content[offset + lline_label_length_max: offset + lline_length], 'ascii').rstrip('\x00')
+            converted_value = self.convert_value(value)
+            bit_pattern = content[0x2D1 + lline_no]
+            if label in ['REPEAT', 'UNTIL', 'ENDREPEAT', 'FOREVER', 'IF', 'ENDIF', 'COUNT']:
+                # print("  Keyword detected!")
+                if label == 'REPEAT':
+                    i = BrickInstructionRepeat(converted_value)
+                elif label == 'UNTIL':
+                    in7_condition, in6_condition = self.convert_condition_commodore(bit_pattern)
+                    i = BrickInstructionUntil(in7_condition, in6_condition)
+                elif label == 'ENDREPEAT':
+                    i = BrickInstructionEndrepeat()
+                elif label == 'FOREVER':
+                    i = BrickInstructionForever()
+                elif label == 'IF':
+                    in7_condition, in6_condition = self.convert_condition_commodore(bit_pattern)
+                    i = BrickInstructionIf(in7_condition, in6_condition)
+                elif label == 'ENDIF':
+                    i = BrickInstructionEndif()
+                elif label == 'COUNT':
+                    in7_condition, in6_condition = self.convert_condition_commodore(bit_pattern)
+                    i = BrickInstructionCount(in7_condition, in6_condition, converted_value)
                 else:
-                    i = BrickInstructionSetOutput(label, bit_patterns[lline_no], converted_value)
-                self.append(i)
+                    assert False, "Lazy programmer forgot something"
+
+            else:
+                i = BrickInstructionSetOutput(label, bit_pattern, converted_value)
+            self.append(i)
+
+    @staticmethod
+    def check_record_commodore(content):
+        # check the fixed layout of a Commodore save file in a memoryview of 762 bytes and return the number of used
+        # lines, or None if it is not a save file
+        num_llines_max = 40
+        lline_length = 16
+
+        if len(content) != COMMODORE_RECORD_LENGTH:
+            return None
+        # these bytes are always zero (unused reserved part of the file?)
+        if (content[0x2F9] != 0xFF) or (content[0x280:0x2D1] != COMMODORE_ZEROS[0x280:0x2D1]):
+            return None
+        # the b'\xff' bytes only come as block at the end of the bit patterns (unused lines)
+        ff_run_start = 0x2F9
+        while (ff_run_start > 0x2D1) and (content[ff_run_start - 1] == 0xFF):
+            ff_run_start -= 1
+        num_llines_used = ff_run_start - 0x2D1
+        if not (0 <= num_llines_used <= num_llines_max):
+            return None
+        # all used lines have a label and there is only plain ASCII text
+        for lline_no in range(num_llines_used):
+            if not (0x20 < content[lline_no * lline_length] < 0x7F):
+                return None
+        text = content[:num_llines_used * lline_length].tobytes()
+        if not text.isascii() or (b'\x7f' in text):
+            return None
+        # this section of the file should also be unused
+        if content[num_llines_used * lline_length:0x2D1] != COMMODORE_ZEROS[num_llines_used * lline_length:0x2D1]:
+            return None
+        return num_llines_used
+
+    @classmethod
+    def scan_commodore(cls, buffer):
+        # lazily yield (offset, program) for every Commodore save file embedded in a larger buffer, e.g. a disk image,
+        # a tar archive or concatenated dumps; the buffer (e.g. an mmap) is scanned in place without copying it
+        import re
+
+        view = memoryview(buffer).cast('B')
+        matches = re.finditer(rb'\xff+', view)
+        try:
+            # a save file ends with a block of 1..41 b'\xff' bytes (unused lines and end marker); usually, the block
+            # ends with the save file, else (more b'\xff' bytes following) try the candidates with the most used lines
+            # first, as a shifted candidate can only have fewer
+            for m in matches:
+                first, last = max(m.start() + 1, COMMODORE_RECORD_LENGTH), min(m.start() + 41, m.end())
+                candidates = range(first, last + 1)
+                if last == m.end():
+                    candidates = [last] + list(range(first, last))
+                for end in candidates:
+                    with view[end - COMMODORE_RECORD_LENGTH: end] as record:
+                        if cls.check_record_commodore(record) is None:
+                            continue
+                        p = cls()
+                        try:
+                            p.from_bytes_commodore(record)
+                        except (AssertionError, ValueError):
+                            continue
+                    yield end - COMMODORE_RECORD_LENGTH, p
+                    break
+        finally:
+            # the buffer (e.g. an mmap) can only be closed once all views on it are gone
+            del matches
+            view.release()
+
+    @classmethod
+    def scan_file_commodore(cls, filename):
+        # like scan_commodore() but memory maps the file, so that large images and archives use constant memory
+        import mmap
+
+        with open(filename, "rb") as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                yield from cls.scan_commodore(buffer)
 
     def from_file_apple(self, filename):
-        with open(filename, "r") as file:
-            flines = [fline.rstrip() for fline in file]
+        with open(filename, "rb") as file:
+            self.from_bytes_apple(file.read())
+
+    def from_bytes_apple(self, content):
+        flines = [fline.rstrip() for fline in content.decode('latin-1').splitlines()]
+        keyword_inputs, keyword_outputs = None, None
 
         num_flines = len(flines)
         # print(f"Num lines in file: {num_flines}")  # debugging only
@@ -246,6 +1342,11 @@ class BrickLines:
             label, view_pattern, number = self.split_view_apple(label_len, view)
             # pp = self.parse_view_pattern_apple(view_pattern)
             lline_type = int(flines[fline_no + 2])
+            # remember how keywords are displayed, there are different variants in the wild
+            if (lline_type == 2) and (keyword_inputs is None):
+                keyword_inputs = view_pattern[:4]
+            if (lline_type != 0) and (keyword_outputs is None):
+                keyword_outputs = view_pattern[5:]
             bit_pattern = int(flines[fline_no + 3])
             # debugging only
             # print(f"{label: <13}{pp} tp={lline_type}, bp={bit_pattern}", end="")
@@ -254,6 +1355,131 @@ class BrickLines:
             # else:
             #     print()
             self.append(self.convert2instruction_apple(label, lline_type, bit_pattern, number))
+        self.apple_keyword_style = (keyword_inputs or self.apple_keyword_style_default[0],
+                                    keyword_outputs or self.apple_keyword_style_default[1])
+
+    def to_file(self, filename, file_format=None):
+        # file format defaults to the one matching the file extension: '.lin' for Commodore, else Apple ][
+        if file_format is None:
+            file_format = BrickFileFormat.COMMODORE \
+                if filename.lower().endswith(FILE_EXTENSIONS[BrickFileFormat.COMMODORE]) else BrickFileFormat.APPLE_II
+        with open(filename, "wb") as file:
+            file.write(self.to_bytes(file_format))
+
+    def to_bytes(self, file_format):
+        assert file_format in [BrickFileFormat.COMMODORE, BrickFileFormat.APPLE_II], "File format not supported"
+        if file_format == BrickFileFormat.COMMODORE:
+            return self.to_bytes_commodore()
+        return self.to_bytes_apple()
+
+    def truncate_labels(self, file_format):
+        # shorten the labels which do not fit into a file format; returns a warning per shortened label
+        label_length_max = LABEL_LENGTHS_MAX[file_format]
+        warnings = []
+        for line_no, i in enumerate(self.instructions):
+            if (file_format == BrickFileFormat.APPLE_II) and not isinstance(i, BrickInstructionSetOutput):
+                continue
+            if len(i.label) > label_length_max:
+                warnings.append(f"Line {line_no + 1}: label '{i.label}' shortened to '{i.label[:label_length_max]}'")
+                i.label = i.label[:label_length_max]
+        return warnings
+
+    def to_bytes_commodore(self):
+        num_llines_max = 40
+        lline_length = 16
+        lline_label_length_max = 12
+
+        assert len(self.instructions) <= num_llines_max, f"Commodore format is limited to {num_llines_max} lines"
+        content = bytearray(762)
+        content[0x2D1:] = b'\xff' * (762 - 0x2D1)
+        for lline_no, i in enumerate(self.instructions):
+            label = i.label.encode('ascii')
+            value = self.format_value(i.value, leading_zero=True).encode('ascii')
+            assert len(label) <= lline_label_length_max, f"Line {lline_no + 1}: label too long"
+            assert len(value) <= lline_length - lline_label_length_max, f"Line {lline_no + 1}: value too long"
+            offset = lline_no * lline_length
+            content[offset: offset + len(label)] = label
+            offset += lline_label_length_max
+            content[offset: offset + len(value)] = value
+            if isinstance(i, BrickInstructionSetOutput):
+                bit_pattern = i.out_bit_pattern
+            elif isinstance(i, (BrickInstructionUntil, BrickInstructionIf, BrickInstructionCount)):
+                bit_pattern = self.convert_condition2commodore(i.in7_condition, i.in6_condition)
+            else:
+                bit_pattern = 0
+            content[0x2D1 + lline_no] = bit_pattern
+        return bytes(content)
+
+    def to_bytes_apple(self):
+        keyword_inputs, keyword_outputs = self.apple_keyword_style
+        symbols = {None: 'JK', False: 'LM', True: '^_'}
+        flines = [str(len(self.instructions))]
+        for lline_no, i in enumerate(self.instructions):
+            value = self.format_value(i.value, leading_zero=False)
+            assert len(value) <= 4, f"Line {lline_no + 1}: value too long"
+            if isinstance(i, BrickInstructionSetOutput):
+                assert len(i.label) <= LABEL_LENGTHS_MAX[BrickFileFormat.APPLE_II], \
+                    f"Line {lline_no + 1}: label too long"
+                label_view = ' ' + i.label
+                inputs = 'JKJK'
+                outputs = ''.join(symbols[bool(i.out_bit_pattern & (1 << pos))] for pos in range(5, -1, -1))
+                lline_type = 0
+                bit_pattern = i.out_bit_pattern
+            elif isinstance(i, (BrickInstructionUntil, BrickInstructionIf, BrickInstructionCount)):
+                label_view = i.label
+                inputs = symbols[i.in7_condition] + symbols[i.in6_condition]
+                outputs = keyword_outputs
+                lline_type = 1
+                bit_pattern = self.convert_condition2apple(i.in7_condition, i.in6_condition)
+            else:
+                label_view = i.label
+                inputs = keyword_inputs
+                outputs = keyword_outputs
+                lline_type = 2
+                bit_pattern = 0
+            flines.append(str(len(i.label)))
+            flines.append(f";{label_view: <10}~As{inputs}u{outputs}t~@{value: >4}")
+            flines.append(str(lline_type))
+            flines.append(str(bit_pattern))
+        return ''.join(fline + '\r' for fline in flines).encode('latin-1')
+
+    @staticmethod
+    def format_value(value, leading_zero=True):
+        if value is None:
+            return ''
+        r = str(value)
+        if not leading_zero and r.startswith('0.'):
+            # Apple ][ style, e.g. '.2'
+            r = r[1:]
+        return r
+
+    @staticmethod
+    def convert_condition2commodore(in7_condition, in6_condition):
+        # inverse of convert_condition_commodore()
+        bit_pattern = 0
+        if in7_condition is None:
+            bit_pattern |= 1 << 1
+        elif in7_condition:
+            bit_pattern |= 1 << 7
+        if in6_condition is None:
+            bit_pattern |= 1 << 0
+        elif in6_condition:
+            bit_pattern |= 1 << 6
+        return bit_pattern
+
+    @staticmethod
+    def convert_condition2apple(in7_condition, in6_condition):
+        # inverse of convert_condition_apple()
+        bit_pattern = 0
+        if in7_condition is None:
+            bit_pattern |= 1 << 3
+        elif in7_condition:
+            bit_pattern |= 1 << 1
+        if in6_condition is None:
+            bit_pattern |= 1 << 2
+        elif in6_condition:
+            bit_pattern |= 1 << 0
+        return bit_pattern
 
     def convert2instruction_apple(self, label, lline_type, b, value):
         if lline_type == 0:
@@ -429,7 +1655,7 @@ class BrickLines:
         r = ""
 
         if is_active:
-            r += Back.WHITE + Fore.BLACK
+            r += HIGHLIGHT
 
         r += "│ "
 
@@ -441,7 +1667,7 @@ class BrickLines:
         r += f" {line_no + 1: >2} │ " + i.__repr__() + " │\n"
 
         if is_active:
-            r += Style.RESET_ALL
+            r += RESET
 
         return r
 
@@ -455,6 +1681,9 @@ class BrickLines:
     def print(self, active_line_no=None, clear_screen=True):
         if clear_screen:
             self.clear_screen()
+        if active_line_no is not None:
+            # highlighting needs escape sequences, plain tables do not
+            init_terminal()
         r = self.show(active_line_no)
         print(r)
 
@@ -465,137 +1694,515 @@ class BrickLines:
     #        if line_no < len(self.instructions)-1:
     #            sleep(2)
 
-    def set_outputs(self, bit_pattern, wait_time=None, serial_timeout=None):
+    def set_outputs(self, bit_pattern, wait_time=None, serial_timeout=None, force=False):
         # print(f"  will set the outputs to {bit_pattern} & wait for {wait_time}")  # debugging only
+        tx = self.begin_outputs(bit_pattern, force)
+        if tx is not None:
+            self.serial_connection.timeout = serial_timeout
+            # do not wait for the echo here, it is collected during the wait (or before the next transaction)
+            self.write_outputs(tx)
+        self.end_outputs(bit_pattern, wait_time)
+        if self.deadline > self.clock.now():
+            self.collect_echoes()
+        self.clock.sleep_until(self.deadline, self.spin_time)
+        lateness = self.clock.now() - self.deadline
+        self.timing.add(lateness)
+        if self.metrics is not None:
+            self.metrics.observe('sleep_overshoot_seconds', lateness)
+
+    async def set_outputs_async(self, bit_pattern, wait_time=None, serial_timeout=None, force=False):
+        tx = self.begin_outputs(bit_pattern, force)
+        if tx is not None:
+            self.serial_connection.timeout = serial_timeout
+            self.write_outputs(tx)
+        self.end_outputs(bit_pattern, wait_time)
+        if self.deadline > self.clock.now():
+            await self.collect_echoes_async()
+        await self.clock.sleep_until_async(self.deadline)
+        lateness = self.clock.now() - self.deadline
+        self.timing.add(lateness)
+        if self.metrics is not None:
+            self.metrics.observe('sleep_overshoot_seconds', lateness)
+
+    def begin_outputs(self, bit_pattern, force=False):
+        # each wait ends at an absolute deadline which continues from the previous deadline, so that latencies of
+        # the serial connection and rendering do not add up; if the previous deadline lies back too far (e.g.
+        # after waiting for inputs), the timeline is started again from now
+        now = self.clock.now()
+        if (self.deadline is None) or (now - self.deadline > self.resync_threshold):
+            if self.deadline is not None:
+                self.timing.resyncs += 1
+            self.deadline = now
         # don't care about byte order because it's a single byte anyway
         tx = bit_pattern.to_bytes(1, byteorder='little')
-        num_transmitted_bytes = self.serial_connection.write(tx)
-        assert num_transmitted_bytes == 1
-        self.last_out_bit_pattern = tx
-        self.serial_connection.timeout = serial_timeout
-        # read dummy byte but ignore its contents as there's currently no interest in the inputs
-        self.serial_connection.read(1)
+        if force or (tx != self.last_out_bit_pattern):
+            return tx
+        # outputs are already set, no need to bother the serial connection
+        self.skipped_writes += 1
+        return None
+
+    def end_outputs(self, bit_pattern, wait_time):
+        for callback in self.output_callbacks:
+            callback(bit_pattern)
 
         # wait afterwards
         if wait_time is not None:
-            sleep(wait_time)
+            self.deadline += wait_time
         else:
-            # FIXME: wait for default time; what is it? assume 1 second for now
-            sleep(1)
-
-    def read_inputs(self):
-        # resend last output bit pattern so that the output does not change but the inputs can be read
-        tx = self.last_out_bit_pattern
+            self.deadline += self.default_wait_time
+
+    def write_outputs(self, tx):
+        # write without reading the echo, i.e. pipelined; the poller repeats the last bit pattern, so it changes
+        # together with the write (under the same lock) or the poller could set the outputs back in between
+        with self.serial_lock:
+            if self.metrics is not None:
+                start = perf_counter()
+            num_transmitted_bytes = self.serial_connection.write(tx)
+            if self.metrics is not None:
+                self.metrics.observe('serial_write_seconds', perf_counter() - start)
+            assert num_transmitted_bytes == 1
+            self.last_out_bit_pattern = tx
+            self.serial_writes += 1
+            self.pending_echoes += 1
+
+    def collect_echoes(self):
+        # read the echoes of pipelined writes; they also carry the state of the inputs at the time of writing
+        with self.serial_lock:
+            if self.pending_echoes == 0:
+                return
+            if self.metrics is not None:
+                start = perf_counter()
+            rx = self.serial_connection.read(self.pending_echoes)
+            if self.metrics is not None:
+                self.metrics.observe('echo_read_seconds', perf_counter() - start)
+            self.pending_echoes = 0
+            if rx:
+                self.echo_received(rx[-1])
+
+    async def collect_echoes_async(self):
+        if self.pending_echoes == 0:
+            return
+        if self.metrics is not None:
+            start = perf_counter()
+        rx = await self.read_async(self.pending_echoes)
+        if self.metrics is not None:
+            self.metrics.observe('echo_read_seconds', perf_counter() - start)
+        self.pending_echoes = 0
+        if rx:
+            self.echo_received(rx[-1])
+
+    async def read_async(self, size):
+        # wait for the bytes to arrive without blocking the event loop, respecting the serial timeout
+        import asyncio
+        timeout = self.serial_connection.timeout
+        start = monotonic()
+        await asyncio.sleep(0)
+        while self.serial_connection.in_waiting < size:
+            if (timeout is not None) and (monotonic() - start >= timeout):
+                size = self.serial_connection.in_waiting
+                if size == 0:
+                    return b''
+                break
+            await asyncio.sleep(self.async_poll_interval)
+        return self.serial_connection.read(size)
+
+    def echo_received(self, rx):
+        in7 = bool(rx & (1 << 7))
+        in6 = bool(rx & (1 << 6))
+        self.echo_inputs = (self.clock.now(), in7, in6)
+        if self.poller is not None:
+            self.poller.update(in7, in6)
+
+    def transceive(self, tx):
+        # one serial transaction: write a byte and read the answer; locked as a poller may share the connection
+        with self.serial_lock:
+            self.collect_echoes()
+            if self.metrics is not None:
+                start = perf_counter()
+            num_transmitted_bytes = self.serial_connection.write(tx)
+            if self.metrics is not None:
+                written = perf_counter()
+                self.metrics.observe('serial_write_seconds', written - start)
+            assert num_transmitted_bytes == 1
+            self.serial_writes += 1
+            rx = self.serial_connection.read(1)
+            if self.metrics is not None:
+                self.metrics.observe('echo_read_seconds', perf_counter() - written)
+            if rx:
+                self.echo_received(rx[0])
+            return rx
+
+    async def transceive_async(self, tx):
+        await self.collect_echoes_async()
+        if self.metrics is not None:
+            start = perf_counter()
         num_transmitted_bytes = self.serial_connection.write(tx)
+        if self.metrics is not None:
+            written = perf_counter()
+            self.metrics.observe('serial_write_seconds', written - start)
         assert num_transmitted_bytes == 1
+        self.serial_writes += 1
+        rx = await self.read_async(1)
+        if self.metrics is not None:
+            self.metrics.observe('echo_read_seconds', perf_counter() - written)
+        if rx:
+            self.echo_received(rx[0])
+        return rx
+
+    async def read_inputs_async(self):
+        await self.collect_echoes_async()
+        if (self.echo_inputs is not None) and (self.clock.now() - self.echo_inputs[0] <= self.echo_max_age):
+            _, in7, in6 = self.echo_inputs
+        else:
+            await self.transceive_async(self.last_out_bit_pattern)
+            _, in7, in6 = self.echo_inputs
+        self.echo_inputs = None
+        for callback in self.input_callbacks:
+            callback(in7, in6)
+        return in7, in6
 
-        rx = int.from_bytes(self.serial_connection.read(1), byteorder='little')
-        in7 = bool(rx & (1 << 7))
-        in6 = bool(rx & (1 << 6))
+    def read_inputs(self):
+        if self.poller is not None:
+            # latest state sampled in the background, no need to wait for the serial connection
+            in7, in6 = self.poller.inputs()
+        else:
+            self.collect_echoes()
+            if (self.echo_inputs is not None) and (self.clock.now() - self.echo_inputs[0] <= self.echo_max_age):
+                # inputs came along with a recent echo; use them once instead of another transaction
+                _, in7, in6 = self.echo_inputs
+            else:
+                # resend last output bit pattern so that the output does not change but the inputs can be read
+                self.transceive(self.last_out_bit_pattern)
+                _, in7, in6 = self.echo_inputs
+            self.echo_inputs = None
+        for callback in self.input_callbacks:
+            callback(in7, in6)
         return in7, in6
 
-    def run(self):
+    @staticmethod
+    def opcode(instruction):
+        # walk the class hierarchy so that user defined subclasses of the instruction classes compile as well
+        for cls in type(instruction).__mro__:
+            if cls in INSTRUCTION_OPCODES:
+                return INSTRUCTION_OPCODES[cls]
+        assert False, "Unknown instruction"
+
+    def compile(self, instructions=None):
+        # lower the instructions into a packed program with resolved jump targets;
+        # expects the program to have passed check() before
+        if instructions is None:
+            instructions = self.instructions
+        return BrickPackedProgram.from_instructions(instructions).link()
+
+    def to_bytecode(self):
+        # compile into a bytecode image for the Lines executor on the Arduino; expects the program to have passed
+        # check() before; waits without a value get the default wait time
+        program = self.compile()
+        r = bytearray(BYTECODE_HEADER.pack(BYTECODE_MAGIC, BYTECODE_VERSION, self.count_edge.value, len(program),
+                                           round(self.count_debounce * 1000000)))
+        for line_no, op in enumerate(program.opcodes):
+            value = program.value(line_no)
+            operand = 0
+            argument = 0
+            if op == OP_SET_OUTPUT:
+                operand = program.out_bit_patterns[line_no]
+                wait_time = self.default_wait_time if value is None else value
+                argument = round(wait_time * 1000000)
+                # the sketch compares times as signed 32 bit microseconds
+                assert 0 <= argument < 1 << 31, f"Line {line_no + 1}: wait time out of range"
+            elif op in (OP_UNTIL, OP_IF, OP_COUNT):
+                operand = program.conditions[line_no]
+            if op in (OP_REPEAT, OP_COUNT) and (value is not None):
+                assert value == int(value) and 0 <= value < 1 << 32, f"Line {line_no + 1}: value out of range"
+                argument = int(value)
+            r += BYTECODE_RECORD.pack(op, operand, max(program.targets[line_no], 0), argument)
+        return bytes(r)
+
+    def to_arduino_header(self):
+        # C header with the bytecode image to be included by the Lines executor sketch as "program.h"
+        image = self.to_bytecode()
+        r = "// generated by brick_lines.py, do not edit\n"
+        r += "#include <avr/pgmspace.h>\n\n"
+        r += f"const uint8_t program_image[{len(image)}] PROGMEM = {{\n"
+        r += "  " + ", ".join(f"0x{b:02X}" for b in image[:BYTECODE_HEADER.size]) + ",  // header\n"
+        for line_no in range(len(self.instructions)):
+            offset = BYTECODE_HEADER.size + line_no * BYTECODE_RECORD.size
+            record = image[offset: offset + BYTECODE_RECORD.size]
+            r += "  " + ", ".join(f"0x{b:02X}" for b in record) + \
+                 f",  // {line_no + 1}: {self.instructions[line_no].label}\n"
+        r += "};\n"
+        return r
+
+    def add_observer(self, observer):
+        self.observers.append(observer)
+
+    def enable_metrics(self):
+        # counters and histograms of the hot paths, see BrickMetrics; while disabled, the I/O paths only check
+        # for None and the per line accounting is not even part of the observers
+        if self.metrics is None:
+            self.metrics = BrickMetrics(self)
+            self.add_observer(self.metrics)
+        return self.metrics
+
+    def enable_hot_swap(self):
+        # live reload of the running program, see BrickHotSwap; use its reload() or watch()
+        for observer in self.observers:
+            if isinstance(observer, BrickHotSwap):
+                return observer
+        observer = BrickHotSwap(self)
+        # first, so that the other observers do not see the line at which the programs are swapped twice
+        self.observers.insert(0, observer)
+        return observer
+
+    def swap_program(self, swap):
+        # continue with the program of a BrickProgramSwap; the outputs, the connection and the timeline are kept and
+        # so are the counters of the loops with their heads at the same lines in both programs; a counted loop whose
+        # count has been lowered below its counter is left at its next ENDREPEAT
+        assert self.line_map is None, "Programs cannot be swapped while running optimized"
+        loop_counters = [0] * len(swap.program)
+        if swap.restart:
+            self.last_line_no = None
+        else:
+            for line_no in range(min(len(swap.program), len(self.code))):
+                if swap.program.opcodes[line_no] == OP_REPEAT == self.code.opcodes[line_no]:
+                    loop_counters[line_no] = self.loop_counters[line_no]
+        self.instructions = swap.instructions
+        self.code = swap.program
+        self.loop_counters = loop_counters
+        return swap.program
+
+    @staticmethod
+    def observer_callbacks(observers, event):
+        # only collect the callbacks an observer really implements so that absent observers cost nothing
+        return [getattr(o, event) for o in observers
+                if getattr(type(o), event, None) not in (None, getattr(BrickObserver, event))]
+
+    def prepare_run(self, observers, optimize=False):
         self.check()  # check syntax before execution!
-        last_line_no = None  # 'last' not as 'in the end of the program' but 'from the last iteration'
+        if optimize:
+            instructions, self.line_map, self.optimization = self.optimize()
+            program = self.compile(instructions)
+        else:
+            self.line_map = None
+            program = self.compile()
+        self.code = program
+        self.output_callbacks = self.observer_callbacks(observers, 'on_output')
+        self.input_callbacks = self.observer_callbacks(observers, 'on_input')
+        self.loop_callbacks = self.observer_callbacks(observers, 'on_loop_iteration')
+        if self.line_map is not None:
+            # observers get to know the line numbers of the original program
+            line_map = self.line_map
+            self.loop_callbacks = [lambda head, iteration, c=c: c(line_map[head], iteration)
+                                   for c in self.loop_callbacks]
+        self.loop_counters = [0] * len(program)
+        self.deadline = None
+        self.timing = BrickTimingStatistics()
+        self.last_line_no = None  # 'last' not as 'in the end of the program' but 'from the last iteration'
+        return program
+
+    def line_callbacks(self, observers):
+        callbacks = self.observer_callbacks(observers, 'on_line')
+        if self.line_map is None:
+            return callbacks
+        line_map = self.line_map
+        return [lambda line_no, c=c: c(line_map[line_no]) for c in callbacks]
+
+    def end_run(self):
+        self.output_callbacks = []
+        self.input_callbacks = []
+        self.loop_callbacks = []
+
+    def run(self, max_refresh_rate=25, headless=False, observers=(), optimize=False):
+        observers = self.observers + list(observers)
+        if not headless:
+            observers.append(BrickTerminalRenderer(self, max_refresh_rate))
+        program = self.prepare_run(observers, optimize)
+        line_callbacks = self.line_callbacks(observers)
+        swap_callbacks = self.observer_callbacks(observers, 'on_swap')
+        finish_callbacks = self.observer_callbacks(observers, 'on_finish')
+        # one handler per opcode; each handler returns the number of the line to be executed next
+        handlers = (self.execute_set_output, self.execute_repeat, self.execute_until, self.execute_endrepeat,
+                    self.execute_forever, self.execute_if, self.execute_endif, self.execute_count)
+        opcodes = program.opcodes
         line_no = 0
-        running = True
-        loop_nesting = []
-        end_line_no = len(self.instructions)
-        if end_line_no == 0:
-            # program is empty
-            running = False
-        while running:
-            self.print(active_line_no=line_no)
-            # print(f"Line no: {line_no}")
-            i = self.instructions[line_no]
-            if isinstance(i, BrickInstructionSetOutput):
-                self.set_outputs(i.out_bit_pattern, i.value)
-                last_line_no = line_no
-                line_no += 1
-            elif isinstance(i, BrickInstructionRepeat):
-                # check whether loop is entered (from a line above) or
-                # if still looping (another iteration)
-                if (last_line_no is None) or (last_line_no < line_no):
-                    # entering loop first
-                    if i.value is not None:  # counted loop aka 'for loop'
-                        # add another loop nesting level and set loop counter to 0
-                        loop_nesting.append({'head': line_no, 'counter': 0})
-                    else:
-                        # add another loop nesting level and mark loop counter as invalid (irrelevant)
-                        loop_nesting.append({'head': line_no, 'counter': None})
-                # else:
-                #    print("still in loop, nothing to do as condition has been checked before!")
-                last_line_no = line_no
-                line_no += 1
-            elif isinstance(i, BrickInstructionUntil):
-                last_line_no = line_no
-                if self.check_inputs(i.in7_condition, i.in6_condition):
-                    # condition has been met, break out of loop and continue below
-                    line_no += 1
-                    # remove nesting level
-                    loop_nesting.pop()
-                else:
-                    # jump back to top of loop; no need to increment a loop counter
-                    line_no = loop_nesting[-1]['head']
-            elif isinstance(i, BrickInstructionEndrepeat):
-                # counted loop aka 'for loop': increment and check (outermost) loop counter
-                loop_nesting[-1]['counter'] += 1
-                # print(f"  incremented for loop counter to {loop_nesting[-1]['counter']}")
-                last_line_no = line_no
-                if loop_nesting[-1]['counter'] == self.instructions[loop_nesting[-1]['head']].value:
-                    # done, break out of loop
-                    line_no += 1
-                    # remove nesting level
-                    loop_nesting.pop()
-                else:
-                    # jump back to top of loop
-                    line_no = loop_nesting[-1]['head']
-            elif isinstance(i, BrickInstructionForever):
-                last_line_no = line_no
-                # jump back to top of loop
-                line_no = loop_nesting[-1]['head']
-            elif isinstance(i, BrickInstructionIf):
-                last_line_no = line_no
-                if self.check_inputs(i.in7_condition, i.in6_condition):
-                    line_no += 1
-                else:
-                    # go to end of if condition, look for the next ENDIF
-                    for endif_candidate_line_no in range(line_no + 1, end_line_no):
-                        if isinstance(self.instructions[endif_candidate_line_no], BrickInstructionEndif):
-                            line_no = endif_candidate_line_no  # or shall we go to +1 directly?
-                            break  # do not keep searching for other candidates
-            elif isinstance(i, BrickInstructionEndif):
-                # nothing to do
-                last_line_no = line_no
-                line_no += 1
-            elif isinstance(i, BrickInstructionCount):
-                last_line_no = line_no
-                in7, in6 = self.read_inputs()
-                change_counter = 0
-                while change_counter < i.value:
-                    waiting_for_change = True
-                    while waiting_for_change:
-                        new_in7, new_in6 = self.read_inputs()
-                        if (i.in7_condition is True) and (i.in6_condition is None):
-                            if new_in7 != in7:
-                                waiting_for_change = False
-                        elif (i.in6_condition is True) and (i.in7_condition is None):
-                            if new_in6 != in6:
-                                waiting_for_change = False
+        end_line_no = len(program)
+        try:
+            while True:
+                try:
+                    while line_no < end_line_no:
+                        for callback in line_callbacks:
+                            callback(line_no)
+                        next_line_no = handlers[opcodes[line_no]](line_no)
+                        self.last_line_no = line_no
+                        line_no = next_line_no
+                    break
+                except BrickProgramSwap as swap:
+                    # raised at a line boundary, see BrickHotSwap
+                    program = self.swap_program(swap)
+                    opcodes = program.opcodes
+                    line_no = swap.line_no
+                    end_line_no = len(program)
+                    for callback in swap_callbacks:
+                        callback()
+        finally:
+            self.end_run()
+        for callback in finish_callbacks:
+            callback()
+
+    async def run_async(self, observers=(), optimize=False):
+        # same as run() but waits and serial communication do not block the event loop;
+        # always headless as the terminal can only show one program
+        assert self.poller is None, "Background polling is not supported for asynchronous execution"
+        observers = self.observers + list(observers)
+        program = self.prepare_run(observers, optimize)
+        line_callbacks = self.line_callbacks(observers)
+        swap_callbacks = self.observer_callbacks(observers, 'on_swap')
+        finish_callbacks = self.observer_callbacks(observers, 'on_finish')
+        handlers = (self.execute_set_output_async, self.execute_repeat, self.execute_until_async,
+                    self.execute_endrepeat, self.execute_forever, self.execute_if_async, self.execute_endif,
+                    self.execute_count_async)
+        awaitable = (True, False, True, False, False, True, False, True)
+        opcodes = program.opcodes
+        line_no = 0
+        end_line_no = len(program)
+        try:
+            while True:
+                try:
+                    while line_no < end_line_no:
+                        for callback in line_callbacks:
+                            callback(line_no)
+                        op = opcodes[line_no]
+                        if awaitable[op]:
+                            next_line_no = await handlers[op](line_no)
                         else:
-                            assert False, "Currently not supported; make sure this is really supported"
-                        in7, in6 = new_in7, new_in6
-                    change_counter += 1
-                line_no += 1
-            else:
-                assert False, "Unknown instruction"
-            if line_no >= end_line_no:
-                running = False
-                # print(f"Hit program end: {line_no} >= {end_line_no}")  # debugging only
-                self.print()
+                            next_line_no = handlers[op](line_no)
+                        self.last_line_no = line_no
+                        line_no = next_line_no
+                    break
+                except BrickProgramSwap as swap:
+                    program = self.swap_program(swap)
+                    opcodes = program.opcodes
+                    line_no = swap.line_no
+                    end_line_no = len(program)
+                    for callback in swap_callbacks:
+                        callback()
+        finally:
+            self.end_run()
+        for callback in finish_callbacks:
+            callback()
+
+    def loop_back(self, head):
+        # another iteration of the loop starting at line 'head'
+        self.loop_counters[head] += 1
+        for callback in self.loop_callbacks:
+            callback(head, self.loop_counters[head])
+        return head
+
+    def execute_set_output(self, line_no):
+        self.set_outputs(self.code.out_bit_patterns[line_no], self.code.value(line_no))
+        return line_no + 1
+
+    async def execute_set_output_async(self, line_no):
+        await self.set_outputs_async(self.code.out_bit_patterns[line_no], self.code.value(line_no))
+        return line_no + 1
+
+    def execute_repeat(self, line_no):
+        # check whether loop is entered (from a line above) or if still looping (another iteration)
+        if (self.last_line_no is None) or (self.last_line_no < line_no):
+            # entering loop first: reset the loop counter (counts the iterations, relevant for counted loops)
+            self.loop_counters[line_no] = 0
+        return line_no + 1
+
+    def execute_until(self, line_no):
+        if self.check_inputs(*self.code.condition(line_no)):
+            # condition has been met, break out of loop and continue below
+            return line_no + 1
+        # jump back to top of loop
+        return self.loop_back(self.code.targets[line_no])
+
+    async def execute_until_async(self, line_no):
+        if await self.check_inputs_async(*self.code.condition(line_no)):
+            return line_no + 1
+        return self.loop_back(self.code.targets[line_no])
+
+    def execute_endrepeat(self, line_no):
+        # counted loop aka 'for loop': increment and check loop counter against the value of the loop head
+        head = self.code.targets[line_no]
+        if self.loop_counters[head] + 1 >= self.code.value(head):
+            # done, break out of loop (also if the count has been lowered by a hot swap in the meantime)
+            return line_no + 1
+        # jump back to top of loop
+        return self.loop_back(head)
+
+    def execute_forever(self, line_no):
+        # jump back to top of loop
+        return self.loop_back(self.code.targets[line_no])
+
+    def execute_if(self, line_no):
+        if self.check_inputs(*self.code.condition(line_no)):
+            return line_no + 1
+        # go to the matching ENDIF
+        return self.code.targets[line_no]
+
+    async def execute_if_async(self, line_no):
+        if await self.check_inputs_async(*self.code.condition(line_no)):
+            return line_no + 1
+        return self.code.targets[line_no]
+
+    def execute_endif(self, line_no):
+        # nothing to do
+        return line_no + 1
+
+    def execute_count(self, line_no):
+        in7_condition, in6_condition = self.code.condition(line_no)
+        self.count_changes(in7_condition, in6_condition, self.code.value(line_no))
+        return line_no + 1
+
+    async def execute_count_async(self, line_no):
+        in7_condition, in6_condition = self.code.condition(line_no)
+        await self.count_changes_async(in7_condition, in6_condition, self.code.value(line_no))
+        return line_no + 1
+
+    def count_changes(self, in7_condition, in6_condition, count):
+        # the gaps between the entries of the poller's change log are no sample intervals, the poller's period is
+        sample_interval = None if self.poller is None else self.poller.period
+        counter = BrickEdgeCounter(in7_condition, in6_condition, self.count_edge, self.count_debounce, sample_interval)
+        self.edge_counter = counter  # keep the latest one for its statistics
+        if self.poller is not None:
+            # count the changes from the poller's change log instead of busy reading the inputs
+            sequence, in7, in6 = self.poller.state()
+            counter.feed(self.clock.now(), in7, in6)
+            while counter.edges < count:
+                changes = self.poller.wait_changes(sequence)
+                if changes and changes[0][0] > sequence + 1:
+                    # the poller's change log overflowed in the meantime
+                    counter.lost_changes += changes[0][0] - sequence - 1
+                for sequence, timestamp, in7, in6 in changes:
+                    for callback in self.input_callbacks:
+                        callback(in7, in6)
+                    counter.feed(timestamp, in7, in6)
+                    if counter.edges >= count:
+                        break
+        else:
+            # sample as fast as the serial connection allows
+            while counter.edges < count:
+                in7, in6 = self.read_inputs()
+                counter.feed(self.clock.now(), in7, in6)
+        if self.metrics is not None:
+            self.metrics.count_finished(counter)
+
+    async def count_changes_async(self, in7_condition, in6_condition, count):
+        counter = BrickEdgeCounter(in7_condition, in6_condition, self.count_edge, self.count_debounce)
+        self.edge_counter = counter
+        while counter.edges < count:
+            in7, in6 = await self.read_inputs_async()
+            counter.feed(self.clock.now(), in7, in6)
+        if self.metrics is not None:
+            self.metrics.count_finished(counter)
 
     @staticmethod
     def clear_screen():
+        init_terminal()
         print("\033c\033[3J", end='')
 
     def check(self):
@@ -651,8 +2258,184 @@ class BrickLines:
             else:
                 assert False
 
+    def optimize(self, round_trip_time=0.002):
+        # peephole optimization of the instructions, keeping the bit patterns which last and the waits; not exactly
+        # the timeline of the outputs, as zero-length pulses and round trips which only read the inputs are removed:
+        # - consecutive output lines with the same bit pattern are merged (adding up their waits)
+        # - output lines without waiting time are dropped if another output line follows right away, i.e. their
+        #   zero-length pulses are not sent anymore
+        # - REPEAT 1 .. ENDREPEAT is unwrapped, empty REPEAT n .. ENDREPEAT and IF .. ENDIF are removed; without the
+        #   round trip to read the inputs of an empty IF, the following waits end about a round trip earlier
+        # returns the optimized instructions, the original line number of each optimized line and a report of the
+        # serial transactions saved at least per run (loops with unknown counts are counted once) and the time
+        # estimated for them; expects the program to have passed check()
+        def wait_time(i):
+            return self.default_wait_time if i.value is None else i.value
+
+        # how often each line is executed at least, considering the loops with a fixed count
+        weights = []
+        factors = [1]
+        for i in self.instructions:
+            if isinstance(i, BrickInstructionRepeat):
+                factors.append(factors[-1] * (i.value if (i.value is not None) and (i.value >= 1) else 1))
+            elif isinstance(i, (BrickInstructionRepeatEnd, BrickInstructionEndif)):
+                factors.pop()
+            weights.append(factors[-1])
+            if isinstance(i, BrickInstructionIf):
+                factors.append(factors[-1])
+        lines = [[i, line_no, weights[line_no]] for line_no, i in enumerate(self.instructions)]
+
+        report = {'lines_before': len(lines), 'lines_after': None, 'merged_outputs': 0, 'dropped_outputs': 0,
+                  'removed_structures': 0, 'transactions': 0}
+        changed = True
+        while changed:
+            changed = False
+            partners = {}
+            heads = []
+            for k, (i, _, _) in enumerate(lines):
+                if isinstance(i, (BrickInstructionRepeat, BrickInstructionIf)):
+                    heads.append(k)
+                elif isinstance(i, (BrickInstructionRepeatEnd, BrickInstructionEndif)):
+                    partners[heads.pop()] = k
+            for k, (i, line_no, weight) in enumerate(lines):
+                n = lines[k + 1][0] if k + 1 < len(lines) else None
+                if isinstance(i, BrickInstructionSetOutput) and isinstance(n, BrickInstructionSetOutput):
+                    if i.out_bit_pattern == n.out_bit_pattern:
+                        # the outputs do not change, the second line would not even be sent
+                        lines[k][0] = BrickInstructionSetOutput(i.label, i.out_bit_pattern,
+                                                                wait_time(i) + wait_time(n))
+                        del lines[k + 1]
+                        report['merged_outputs'] += 1
+                        changed = True
+                        break
+                    if wait_time(i) == 0:
+                        del lines[k]
+                        report['dropped_outputs'] += 1
+                        report['transactions'] += weight
+                        changed = True
+                        break
+                if k in partners:
+                    end = lines[partners[k]][0]
+                    if isinstance(i, BrickInstructionIf) and (partners[k] == k + 1):
+                        # reading the inputs is the only effect of an empty IF
+                        report['transactions'] += weight
+                    elif not (isinstance(i, BrickInstructionRepeat) and isinstance(end, BrickInstructionEndrepeat) and
+                              ((i.value == 1) or ((partners[k] == k + 1) and (i.value >= 1)))):
+                        continue
+                    del lines[partners[k]]
+                    del lines[k]
+                    report['removed_structures'] += 1
+                    changed = True
+                    break
+        report['lines_after'] = len(lines)
+        report['time'] = report['transactions'] * round_trip_time
+        return [i for i, _, _ in lines], [line_no for _, line_no, _ in lines], report
+
+    def analyze(self):
+        # static timing analysis without running the program: walks the structures like check() and computes the
+        # shortest and longest duration (only the waits of the output lines, neglecting serial communication),
+        # float('inf') for unbounded ones; 'terminates' is True, False or None (depends on the inputs);
+        # expects the program to have passed check() before
+        def combine(a, b):
+            # sequential composition of whether two parts terminate
+            if (a is False) or (b is False):
+                return False
+            if (a is None) or (b is None):
+                return None
+            return True
+
+        regions = []
+        warnings = []
+        # the outermost frame is the whole program
+        frames = [{'line_no': None, 'instruction': None, 'min': 0, 'max': 0, 'terminates': True, 'waits': False}]
+        for line_no, i in enumerate(self.instructions, 1):
+            frame = frames[-1]
+            if isinstance(i, BrickInstructionSetOutput):
+                wait_time = self.default_wait_time if i.value is None else i.value
+                frame['min'] += wait_time
+                frame['max'] += wait_time
+                frame['waits'] = frame['waits'] or (wait_time > 0)
+            elif isinstance(i, BrickInstructionCount):
+                frame['max'] = float('inf')
+                frame['terminates'] = combine(frame['terminates'], None)
+                frame['waits'] = True
+            elif isinstance(i, (BrickInstructionRepeat, BrickInstructionIf)):
+                frames.append({'line_no': line_no, 'instruction': i, 'min': 0, 'max': 0, 'terminates': True,
+                               'waits': False})
+            elif isinstance(i, (BrickInstructionUntil, BrickInstructionEndrepeat, BrickInstructionForever,
+                                BrickInstructionEndif)):
+                body = frames.pop()
+                head = body['instruction']
+                iteration = (body['min'], body['max'])
+                if isinstance(i, BrickInstructionEndif):
+                    kind = 'IF'
+                    # the body is skipped if the condition is not met
+                    duration = (0, body['max'])
+                    terminates = True if body['terminates'] is True else None
+                elif isinstance(i, BrickInstructionEndrepeat):
+                    kind = f'REPEAT {head.value}'
+                    # the body runs at least once, ENDREPEAT leaves the loop once the counter reaches the count
+                    iterations = max(1, ceil(head.value))
+                    duration = (body['min'] * iterations, body['max'] * iterations)
+                    terminates = body['terminates']
+                elif isinstance(i, BrickInstructionUntil):
+                    kind = 'UNTIL'
+                    # at least one iteration, the number of iterations depends on the inputs
+                    duration = (body['min'], float('inf'))
+                    terminates = combine(body['terminates'], None)
+                else:
+                    kind = 'FOREVER'
+                    duration = (float('inf'), float('inf'))
+                    terminates = False
+                    warnings.append(f"Line {body['line_no']}: FOREVER loop never terminates")
+                if (kind != 'IF') and not body['waits']:
+                    warnings.append(f"Line {body['line_no']}: {kind} loop has no waiting time (busy loop)")
+                if terminates is False:
+                    duration = (float('inf'), float('inf'))
+                regions.append({'line_no': body['line_no'], 'end_line_no': line_no, 'kind': kind,
+                                'iteration': iteration, 'min': duration[0], 'max': duration[1],
+                                'exact': duration[0] == duration[1] != float('inf'), 'terminates': terminates})
+                frame = frames[-1]
+                frame['min'] += duration[0]
+                frame['max'] += duration[1]
+                frame['terminates'] = combine(frame['terminates'], terminates)
+                frame['waits'] = frame['waits'] or body['waits']
+        program = frames.pop()
+        if program['terminates'] is False:
+            program['min'] = program['max'] = float('inf')
+        regions.sort(key=lambda r: r['line_no'])
+        return {'min': program['min'], 'max': program['max'],
+                'exact': program['min'] == program['max'] != float('inf'),
+                'terminates': program['terminates'], 'regions': regions, 'warnings': warnings}
+
+    @staticmethod
+    def show_analysis(analysis):
+        def duration(d):
+            return "unbounded" if d == float('inf') else f"{d:g} s"
+
+        def bounds(a, b):
+            return duration(a) if a == b else f"{duration(a)} .. {duration(b)}"
+
+        terminates = {True: "yes", False: "never", None: "depends on inputs"}
+        r = f"Duration: {bounds(analysis['min'], analysis['max'])}\n"
+        r += f"Terminates: {terminates[analysis['terminates']]}\n"
+        for region in analysis['regions']:
+            r += f"Lines {region['line_no']: >2}..{region['end_line_no']: >2} {region['kind']: <12} " \
+                 f"{bounds(region['min'], region['max'])} (one pass: {bounds(*region['iteration'])})\n"
+        for warning in analysis['warnings']:
+            r += f"Warning: {warning}\n"
+        return r
+
     def check_inputs(self, in7_condition, in6_condition):
         in7, in6 = self.read_inputs()
+        return self.evaluate_condition(in7_condition, in6_condition, in7, in6)
+
+    async def check_inputs_async(self, in7_condition, in6_condition):
+        in7, in6 = await self.read_inputs_async()
+        return self.evaluate_condition(in7_condition, in6_condition, in7, in6)
+
+    @staticmethod
+    def evaluate_condition(in7_condition, in6_condition, in7, in6):
         if (in7_condition is not None) and (in6_condition is not None):
             # both inputs need to be checked
             condition = (in7 == in7_condition) and (in6 == in6_condition)
@@ -665,19 +2448,1623 @@ class BrickLines:
         return condition
 
 
+class BrickInputPoller:
+    # keeps polling the inputs of Interface A in a background thread, caches their latest state and logs
+    # every change with a timestamp (sequence number, time, in7, in6)
+
+    def __init__(self, program, rate=500, log_size=1024):
+        from collections import deque
+        init_threading()
+
+        self.program = program
+        self.period = 1 / rate
+        self.changes = deque(maxlen=log_size)
+        self.sequence = 0
+        self.in7 = None
+        self.in6 = None
+        self.timestamp = None
+        self.condition = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        # take a first sample so that a valid state is available right away
+        self.sample()
+
+        self.running = True
+        self.thread = threading.Thread(target=self.poll, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def poll(self):
+        while self.running:
+            self.sample()
+            sleep(self.period)
+
+    def sample(self):
+        # the echo of the transaction updates the state, see BrickLines.echo_received(); locked so that the outputs
+        # are not set back to a bit pattern which has been replaced in the meantime
+        with self.program.serial_lock:
+            self.program.transceive(self.program.last_out_bit_pattern)
+
+    def update(self, in7, in6):
+        now = self.program.clock.now()
+        with self.condition:
+            self.timestamp = now
+            if (in7 != self.in7) or (in6 != self.in6):
+                self.in7 = in7
+                self.in6 = in6
+                self.sequence += 1
+                self.changes.append((self.sequence, now, in7, in6))
+                self.condition.notify_all()
+
+    def inputs(self):
+        with self.condition:
+            return self.in7, self.in6
+
+    def state(self):
+        with self.condition:
+            return self.sequence, self.in7, self.in6
+
+    def wait_changes(self, since_sequence, timeout=None):
+        # block until the inputs changed after the given sequence number; returns the logged changes since then
+        with self.condition:
+            self.condition.wait_for(lambda: self.sequence > since_sequence, timeout)
+            return [c for c in self.changes if c[0] > since_sequence]
+
+
+class BrickEdgeCounter:
+    # counts edges on the inputs selected by a COUNT condition (IN7, IN6 or both) from timestamped samples;
+    # after an accepted edge, further changes of that input are ignored for the debounce time and only
+    # accepted afterward if the input still differs; if the samples are taken elsewhere and only their changes are
+    # fed (e.g. from the change log of BrickInputPoller), pass the interval at which they have been taken
+
+    def __init__(self, in7_condition, in6_condition, edge=BrickEdge.BOTH, debounce=0, sample_interval=None):
+        assert (in7_condition is not None) or (in6_condition is not None), "No input selected for counting"
+        assert isinstance(edge, BrickEdge)
+        self.watch = (in7_condition is not None, in6_condition is not None)
+        self.edge = edge
+        self.debounce = debounce
+        self.levels = None
+        self.last_edge_times = [None, None]
+        self.last_sample_time = None
+        self.edges = 0
+        # statistics
+        self.samples = 0
+        self.bounces = 0  # samples whose changes have been ignored because of debouncing
+        self.lost_changes = 0  # changes known to be lost, e.g. due to an overflowing change log
+        self.sample_interval = sample_interval  # longest time between two samples
+        self.measure_sample_interval = sample_interval is None
+        self.edge_interval = None  # shortest time between two accepted edges
+        self.undersampled = 0  # edges which followed the previous edge faster than twice the sample interval
+
+    def feed(self, timestamp, in7, in6):
+        self.samples += 1
+        if self.measure_sample_interval and (self.last_sample_time is not None):
+            interval = timestamp - self.last_sample_time
+            if (self.sample_interval is None) or (interval > self.sample_interval):
+                self.sample_interval = interval
+        self.last_sample_time = timestamp
+        if self.levels is None:
+            # first sample only determines the initial levels
+            self.levels = [in7, in6]
+            return
+        for index, level in enumerate((in7, in6)):
+            if not self.watch[index] or level == self.levels[index]:
+                continue
+            last_edge_time = self.last_edge_times[index]
+            if (last_edge_time is not None) and (timestamp - last_edge_time < self.debounce):
+                self.bounces += 1
+                continue
+            self.levels[index] = level
+            self.last_edge_times[index] = timestamp
+            if last_edge_time is not None:
+                interval = timestamp - last_edge_time
+                if (self.edge_interval is None) or (interval < self.edge_interval):
+                    self.edge_interval = interval
+                if (self.sample_interval is not None) and (interval < 2 * self.sample_interval):
+                    self.undersampled += 1
+            if (self.edge == BrickEdge.BOTH) or ((self.edge == BrickEdge.RISING) == level):
+                self.edges += 1
+
+    def statistics(self):
+        return {'edges': self.edges, 'samples': self.samples, 'bounces': self.bounces,
+                'lost_changes': self.lost_changes, 'sample_interval': self.sample_interval,
+                'edge_interval': self.edge_interval, 'undersampled': self.undersampled}
+
+
+class BrickObserver:
+    # base class for observers attached to BrickLines.run(); override only the events of interest
+
+    def on_line(self, line_no):
+        pass
+
+    def on_output(self, bit_pattern):
+        pass
+
+    def on_input(self, in7, in6):
+        pass
+
+    def on_loop_iteration(self, head_line_no, iteration):
+        pass
+
+    def on_swap(self):
+        # the running program has been replaced, see BrickHotSwap
+        pass
+
+    def on_finish(self):
+        pass
+
+
+class BrickTerminalRenderer(BrickObserver):
+    # draws the program table once and afterward only repaints the rows whose highlighting changes,
+    # using cursor positioning escape sequences instead of clearing and redrawing the whole screen
+    header_rows = 4
+
+    def __init__(self, program, max_refresh_rate=25):
+        self.program = program
+        # minimum time between two repaints; steps in between are not rendered so that rendering
+        # never throttles execution, the most recent state is caught up with once the interval is over (by a timer,
+        # as the program may be blocked waiting by then, e.g. for the delay of an output line)
+        self.min_interval = 1 / max_refresh_rate if max_refresh_rate else 0
+        self.rows = []
+        self.active_rows = []
+        self.shown_line_no = None
+        self.pending_line_no = None
+        self.last_refresh = None
+        self.incremental = True
+        init_threading()
+        self.lock = threading.Lock()  # the timer repaints from another thread
+        self.flush_timer = None
+
+    def on_line(self, line_no):
+        if not self.rows:
+            self.render(self.draw)
+        self.update(line_no)
+
+    def render(self, action):
+        # rendering time is accounted to the program's metrics (if enabled)
+        if self.program.metrics is None:
+            action()
+            return
+        start = perf_counter()
+        action()
+        self.program.metrics.observe('render_seconds', perf_counter() - start)
+
+    def on_swap(self):
+        # draw the new program on the next line
+        with self.lock:
+            self.cancel_flush()
+            self.rows = []
+
+    def on_finish(self):
+        if self.rows:
+            self.finish()
+
+    def draw(self):
+        init_terminal()
+        num_lines = len(self.program.instructions)
+        self.rows = [self.program.show_line(line_no) for line_no in range(num_lines)]
+        self.active_rows = [None] * num_lines
+        self.shown_line_no = None
+        self.pending_line_no = None
+        self.last_refresh = None
+        # cursor positioning only works if the whole table fits into the terminal without scrolling
+        import shutil
+
+        self.incremental = self.header_rows + num_lines + 2 <= shutil.get_terminal_size().lines
+        self.program.clear_screen()
+        sys.stdout.write(self.program.show_header() + "".join(self.rows) + self.program.show_footer())
+        sys.stdout.flush()
+
+    def render_row(self, line_no, is_active):
+        if not is_active:
+            return self.rows[line_no]
+        if self.active_rows[line_no] is None:
+            self.active_rows[line_no] = self.program.show_line(line_no, True)
+        return self.active_rows[line_no]
+
+    def update(self, active_line_no):
+        with self.lock:
+            self.pending_line_no = active_line_no
+            now = monotonic()
+            if (self.last_refresh is not None) and (now - self.last_refresh < self.min_interval):
+                if self.flush_timer is None:
+                    self.flush_timer = threading.Timer(self.last_refresh + self.min_interval - now, self.flush)
+                    self.flush_timer.daemon = True
+                    self.flush_timer.start()
+                return
+            self.last_refresh = now
+            self.render(self.repaint)
+
+    def flush(self):
+        # trailing edge: paints the step which was skipped last
+        with self.lock:
+            self.flush_timer = None
+            if self.rows:
+                self.last_refresh = monotonic()
+                self.render(self.repaint)
+
+    def cancel_flush(self):
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+
+    def repaint(self):
+        active_line_no = self.pending_line_no
+        if active_line_no == self.shown_line_no:
+            return
+        if not self.incremental:
+            self.program.print(active_line_no=active_line_no)
+            self.shown_line_no = active_line_no
+            return
+        r = ""
+        for line_no, is_active in ((self.shown_line_no, False), (active_line_no, True)):
+            if line_no is not None:
+                # rows are 1-based, table lines start below the header
+                r += f"\033[{self.header_rows + line_no + 1};1H" + self.render_row(line_no, is_active)
+        # park the cursor below the footer
+        r += f"\033[{self.header_rows + len(self.rows) + 2};1H"
+        sys.stdout.write(r)
+        sys.stdout.flush()
+        self.shown_line_no = active_line_no
+
+    def finish(self):
+        with self.lock:
+            self.cancel_flush()
+            self.pending_line_no = None
+            self.render(self.repaint)
+
+
+class BrickExecutionLimit(Exception):
+    pass
+
+
+class BrickLimiter(BrickObserver):
+    # stops a program by raising BrickExecutionLimit after a maximum number of executed lines or
+    # a maximum (virtual) run time, e.g. for programs which run forever; if a simulated interface is given,
+    # also stops a COUNT which waits for input changes after the end of the input trace
+    def __init__(self, program, max_steps=None, max_time=None, interface=None):
+        self.program = program
+        self.max_steps = max_steps
+        self.end_time = None if max_time is None else program.clock.now() + max_time
+        self.interface = interface
+        self.steps = 0
+        self.samples = 0  # input samples since the last executed line
+        self.last_inputs = None
+
+    def on_line(self, line_no):
+        self.steps += 1
+        self.samples = 0
+        if (self.max_steps is not None) and (self.steps > self.max_steps):
+            raise BrickExecutionLimit("Maximum number of steps exceeded")
+        self.check_time()
+
+    def on_input(self, in7, in6):
+        # a COUNT may wait for inputs which never change
+        self.samples += 1
+        if (self.interface is not None) and (self.samples > 2) and (self.last_inputs == (in7, in6)) and \
+                (self.interface.trace_index >= len(self.interface.input_trace)):
+            raise BrickExecutionLimit("Waiting for input changes after the end of the input trace")
+        self.last_inputs = (in7, in6)
+        self.check_time()
+
+    def check_time(self):
+        if (self.end_time is not None) and (self.program.clock.now() > self.end_time):
+            raise BrickExecutionLimit("Maximum run time exceeded")
+
+
+class BrickProgramSwap(Exception):
+    # raised by BrickHotSwap at a safe point to make run() continue with another program at line line_no;
+    # with restart, the new program starts over instead of carrying over the state of the loops
+    def __init__(self, instructions, program, line_no, restart):
+        super().__init__("Program swapped")
+        self.instructions = instructions
+        self.program = program
+        self.line_no = line_no
+        self.restart = restart
+
+
+class BrickHotSwap(BrickObserver):
+    # live reload of a running program, see BrickLines.enable_hot_swap(): reload() checks and compiles the new
+    # instructions in the calling thread (e.g. the one of watch()) and the running program switches over to them at
+    # its next safe point, keeping the outputs, the connection and the timeline; safe points are the boundaries
+    # between lines outside of all structures and the heads of loops being looped back to; the new program
+    # continues at the same line if it has the same structure there, otherwise it starts over at a line boundary
+    # outside of all structures
+
+    def __init__(self, program):
+        self.program = program
+        self.pending = None  # (instructions, packed program, nesting depths) waiting for a safe point
+        self.depths = None  # nesting depths of the running program
+        self.depths_code = None
+        self.swaps = 0
+        self.error = None  # message of the latest failed reload
+        self.running = False
+        self.thread = None
+
+    @staticmethod
+    def nesting_depths(program):
+        # number of structures around each line boundary, i.e. before line_no and after the last line;
+        # lines closing a structure are still inside of it
+        depths = [0]
+        for op in program.opcodes:
+            depth = depths[-1]
+            if op in (OP_REPEAT, OP_IF):
+                depth += 1
+            elif op in (OP_UNTIL, OP_ENDREPEAT, OP_FOREVER, OP_ENDIF):
+                depth -= 1
+            depths.append(depth)
+        return depths
+
+    def reload(self, instructions):
+        # raises an AssertionError (and keeps the running program) if the new instructions do not pass check()
+        candidate = BrickLines()
+        candidate.instructions = list(instructions)
+        candidate.check()
+        program = candidate.compile()
+        self.pending = (candidate.instructions, program, self.nesting_depths(program))
+
+    def reload_file(self, filename):
+        candidate = BrickLines()
+        candidate.from_file(filename)
+        self.reload(candidate.instructions)
+
+    def watch(self, filename, interval=0.5):
+        # reload the save file whenever it has been modified; a failing reload is reported in error
+        init_threading()
+
+        self.stop()
+        self.running = True
+        self.thread = threading.Thread(target=self.poll, args=(filename, interval), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def poll(self, filename, interval):
+        modified = os.stat(filename).st_mtime_ns
+        while self.running:
+            sleep(interval)
+            try:
+                current = os.stat(filename).st_mtime_ns
+                if current == modified:
+                    continue
+                modified = current
+                self.reload_file(filename)
+                self.error = None
+            except Exception as e:
+                # e.g. the file being saved right now; the next modification gets another chance
+                self.error = str(e)
+                print(f"Reloading {filename} failed: {e}", file=sys.stderr)
+
+    def on_line(self, line_no):
+        if self.pending is None:
+            return
+        code = self.program.code
+        if self.depths_code is not code:
+            self.depths = self.nesting_depths(code)
+            self.depths_code = code
+        depth = self.depths[line_no]
+        last_line_no = self.program.last_line_no
+        looping_back = (code.opcodes[line_no] == OP_REPEAT) and (last_line_no is not None) and \
+            (last_line_no > line_no)
+        if (depth > 0) and not looping_back:
+            return
+        instructions, program, depths = self.pending
+        if (line_no < len(program)) and (depths[line_no] == depth) and \
+                ((program.opcodes[line_no] == OP_REPEAT) or not looping_back):
+            swap = BrickProgramSwap(instructions, program, line_no, False)
+        elif depth == 0:
+            swap = BrickProgramSwap(instructions, program, 0, True)
+        else:
+            return  # wait for a loop head matching the new program or for the outermost level
+        self.pending = None
+        self.swaps += 1
+        raise swap
+
+
+# binary execution traces: a header with magic, version, record size, capacity (number of records) and the number of
+# records written so far, followed by a ring buffer of records with time, kind of event and value (line number,
+# output bit pattern or inputs with IN7 in bit 1 and IN6 in bit 0); all little endian
+TRACE_MAGIC = b'BLTR'
+TRACE_VERSION = 1
+TRACE_HEADER = struct.Struct('<4sBBxxQQ')
+TRACE_RECORD = struct.Struct('<dBxH')
+TRACE_LINE = 1
+TRACE_OUTPUT = 2
+TRACE_INPUT = 3
+
+
+class BrickTraceRecorder(BrickObserver):
+    # records every executed line, output bit pattern and input sample with its time into a memory mapped file;
+    # the file has a fixed size and keeps the latest 'capacity' records, it is consistent after every record
+    # (even if the program gets killed)
+
+    def __init__(self, program, filename, capacity=65536):
+        import mmap
+
+        self.program = program
+        self.capacity = capacity
+        self.count = 0
+        size = TRACE_HEADER.size + capacity * TRACE_RECORD.size
+        with open(filename, "w+b") as file:
+            file.truncate(size)
+            self.buffer = mmap.mmap(file.fileno(), size)
+        TRACE_HEADER.pack_into(self.buffer, 0, TRACE_MAGIC, TRACE_VERSION, TRACE_RECORD.size, capacity, 0)
+
+    def record(self, kind, value):
+        offset = TRACE_HEADER.size + (self.count % self.capacity) * TRACE_RECORD.size
+        TRACE_RECORD.pack_into(self.buffer, offset, self.program.clock.now(), kind, value)
+        self.count += 1
+        # the number of records is the last field of the header
+        struct.pack_into('<Q', self.buffer, TRACE_HEADER.size - 8, self.count)
+
+    def on_line(self, line_no):
+        self.record(TRACE_LINE, line_no)
+
+    def on_output(self, bit_pattern):
+        self.record(TRACE_OUTPUT, bit_pattern)
+
+    def on_input(self, in7, in6):
+        self.record(TRACE_INPUT, (in7 << 1) | in6)
+
+    def on_finish(self):
+        self.buffer.flush()
+
+    def close(self):
+        self.buffer.flush()
+        self.buffer.close()
+
+
+def read_trace(filename):
+    # returns the records (time, kind, value) of a trace file from the oldest to the newest one and whether older
+    # records have been overwritten
+    with open(filename, "rb") as file:
+        data = file.read()
+    magic, version, record_size, capacity, count = TRACE_HEADER.unpack_from(data)
+    assert magic == TRACE_MAGIC, "Not a trace file"
+    assert (version == TRACE_VERSION) and (record_size == TRACE_RECORD.size), "Unsupported trace version"
+    records = list(TRACE_RECORD.iter_unpack(data[TRACE_HEADER.size: TRACE_HEADER.size + min(count, capacity) *
+                                                                    TRACE_RECORD.size]))
+    if count > capacity:
+        first = count % capacity
+        records = records[first:] + records[:first]
+    return records, count > capacity
+
+
+class BrickTraceReplayer(BrickObserver):
+    # re-drives a program from a recorded trace on virtual time: read_inputs() returns the recorded input samples in
+    # their order (and the clock jumps to the time they have been recorded at), so that input dependent behavior is
+    # reproduced deterministically and without waiting; stops as soon as the executed lines differ from the trace
+
+    def __init__(self, filename):
+        records, wrapped = read_trace(filename)
+        assert not wrapped, "Trace is incomplete, its beginning has been overwritten"
+        assert records, "Trace is empty"
+        start_time = records[0][0]
+        self.lines = [value for _, kind, value in records if kind == TRACE_LINE]
+        self.inputs = [(t - start_time, bool(value & 2), bool(value & 1)) for t, kind, value in records
+                       if kind == TRACE_INPUT]
+        self.program = None
+        self.start_time = None
+        self.line_index = 0
+        self.input_index = 0
+        self.divergence = None  # (index of the line, recorded line number, replayed line number)
+
+    def on_line(self, line_no):
+        if self.line_index >= len(self.lines):
+            raise BrickExecutionLimit("End of the trace")
+        if self.lines[self.line_index] != line_no:
+            self.divergence = (self.line_index, self.lines[self.line_index], line_no)
+            raise BrickExecutionLimit(f"Replay differs from the trace at executed line {self.line_index + 1}: "
+                                      f"line {line_no + 1} instead of line {self.lines[self.line_index] + 1}")
+        self.line_index += 1
+
+    def read_inputs(self):
+        if self.input_index >= len(self.inputs):
+            raise BrickExecutionLimit("End of the recorded input samples")
+        t, in7, in6 = self.inputs[self.input_index]
+        self.input_index += 1
+        self.program.clock.sleep_until(self.start_time + t)
+        for callback in self.program.input_callbacks:
+            callback(in7, in6)
+        return in7, in6
+
+    def replay(self, program, headless=True, observers=(), optimize=False):
+        # returns a dictionary with the number of replayed lines, whether the whole trace has been replayed and an
+        # error message (e.g. when the replay differs from the trace)
+        self.program = program
+        self.line_index = 0
+        self.input_index = 0
+        self.divergence = None
+        interface = program.simulate()
+        self.start_time = program.clock.now()
+        result = {'lines': 0, 'completed': False, 'error': None}
+        # replace the method of this very instance only
+        program.read_inputs = self.read_inputs
+        try:
+            program.run(headless=headless, observers=[self] + list(observers), optimize=optimize)
+            result['completed'] = self.line_index == len(self.lines)
+        except BrickExecutionLimit as e:
+            result['error'] = str(e)
+            result['completed'] = (self.divergence is None) and (self.line_index == len(self.lines))
+        finally:
+            del program.read_inputs
+        result['lines'] = self.line_index
+        result['outputs'] = interface.out_bit_pattern
+        return result
+
+
+class BrickVcdWriter(BrickObserver):
+    # streams the bit-level timeline of the outputs and inputs (and optionally the executed line) as Value Change Dump,
+    # e.g. for GTKWave or PulseView; only changes are written and nothing is kept in memory, so that long runs do not
+    # grow; times are microseconds since the first event
+    signals = ('out0', 'out1', 'out2', 'out3', 'out4', 'out5', 'in6', 'in7')
+
+    def __init__(self, program, filename, lines=False):
+        self.program = program
+        self.lines = lines
+        self.file = open(filename, "w")
+        self.start_time = None
+        self.last_time = None
+        self.values = [None] * len(self.signals)
+        self.line_no = None
+        self.write_header()
+
+    def write_header(self):
+        r = "$version BRICK Lines $end\n$timescale 1us $end\n$scope module interface_a $end\n"
+        for index, name in enumerate(self.signals):
+            # identifiers are single printable characters starting at '!'
+            r += f"$var wire 1 {chr(33 + index)} {name} $end\n"
+        if self.lines:
+            r += f"$var integer 16 {chr(33 + len(self.signals))} line $end\n"
+        r += "$upscope $end\n$enddefinitions $end\n"
+        self.file.write(r)
+
+    def timestamp(self):
+        now = self.program.clock.now()
+        if self.start_time is None:
+            self.start_time = now
+            self.file.write("#0\n$dumpvars\n" + "".join(f"x{chr(33 + index)}\n" for index in range(len(self.signals))) +
+                            "$end\n")
+            self.last_time = 0
+        t = round((now - self.start_time) * 1000000)
+        if t > self.last_time:
+            self.file.write(f"#{t}\n")
+            self.last_time = t
+
+    def change(self, first_index, values):
+        r = ""
+        for index, value in enumerate(values, first_index):
+            if self.values[index] != value:
+                self.values[index] = value
+                r += f"{int(value)}{chr(33 + index)}\n"
+        if r:
+            self.timestamp()
+            self.file.write(r)
+
+    def on_line(self, line_no):
+        if self.lines and (line_no != self.line_no):
+            self.line_no = line_no
+            self.timestamp()
+            self.file.write(f"b{line_no + 1:b} {chr(33 + len(self.signals))}\n")
+
+    def on_output(self, bit_pattern):
+        self.change(0, [bool(bit_pattern & (1 << pos)) for pos in range(6)])
+
+    def on_input(self, in7, in6):
+        self.change(6, (in6, in7))
+
+    def on_finish(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    @classmethod
+    def from_trace(cls, trace_filename, vcd_filename, lines=True):
+        # convert a trace file recorded by BrickTraceRecorder
+        records, _ = read_trace(trace_filename)
+        clock = BrickVirtualClock()
+        writer = cls(BrickLines(), vcd_filename, lines)
+        writer.program.clock = clock
+        for t, kind, value in records:
+            clock.time = t
+            if kind == TRACE_LINE:
+                writer.on_line(value)
+            elif kind == TRACE_OUTPUT:
+                writer.on_output(value)
+            elif kind == TRACE_INPUT:
+                writer.on_input(bool(value & 2), bool(value & 1))
+        writer.close()
+
+
+class BrickHistogram:
+    # distribution of observed values in fixed buckets (upper bounds, Prometheus style) plus sum and maximum
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one counts values above all bounds
+        self.count = 0
+        self.sum = 0
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if (self.max is None) or (value > self.max):
+            self.max = value
+
+    def cumulative(self):
+        # (upper bound, number of values up to it) including +Inf
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            yield bound, total
+
+
+class BrickMetrics(BrickObserver):
+    # counters and histograms of the hot paths of a program (per I/O operation and per executed line),
+    # see BrickLines.enable_metrics(); exported in the text format of Prometheus or as a summary for humans
+    prefix = 'brick_lines_'
+    latency_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+    line_buckets = (0.001, 0.01, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 300)
+    poll_buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+    histogram_help = {
+        'serial_write_seconds': "Time to write a byte to the serial connection",
+        'echo_read_seconds': "Time to read the echoes of Interface A",
+        'render_seconds': "Time to render the program in the terminal",
+        'sleep_overshoot_seconds': "How late the waits after setting the outputs ended",
+        'count_polls_per_edge': "Input samples per counted edge of a COUNT line",
+    }
+
+    def __init__(self, program):
+        self.program = program
+        self.histograms = {name: BrickHistogram(self.poll_buckets if name == 'count_polls_per_edge'
+                                                else self.latency_buckets) for name in self.histogram_help}
+        self.line_steps = {}
+        self.line_times = {}
+        self.active_line_no = None
+        self.line_start = None
+        self.count_edges = 0
+        self.count_samples = 0
+        self.count_bounces = 0
+        self.start = monotonic()
+
+    def observe(self, name, value):
+        self.histograms[name].observe(value)
+
+    def count_finished(self, counter):
+        # statistics of a BrickEdgeCounter after its COUNT line
+        self.count_edges += counter.edges
+        self.count_samples += counter.samples
+        self.count_bounces += counter.bounces
+        if counter.edges:
+            self.observe('count_polls_per_edge', counter.samples / counter.edges)
+
+    def on_line(self, line_no):
+        now = self.program.clock.now()
+        self.end_line(now)
+        self.line_steps[line_no] = self.line_steps.get(line_no, 0) + 1
+        self.active_line_no = line_no
+        self.line_start = now
+
+    def end_line(self, now):
+        # the time of a line lasts until the next line is executed
+        if self.active_line_no is None:
+            return
+        histogram = self.line_times.get(self.active_line_no)
+        if histogram is None:
+            histogram = self.line_times[self.active_line_no] = BrickHistogram(self.line_buckets)
+        histogram.observe(now - self.line_start)
+
+    def on_finish(self):
+        self.end_line(self.program.clock.now())
+        self.active_line_no = None
+
+    def counters(self):
+        p = self.program
+        return {
+            'serial_writes_total': (p.serial_writes, "Bytes written to the serial connection"),
+            'skipped_writes_total': (p.skipped_writes, "Writes skipped as the outputs were already set"),
+            'resyncs_total': (p.timing.resyncs, "Restarts of the timeline of the waits"),
+            'count_edges_total': (self.count_edges, "Edges counted by COUNT lines"),
+            'count_samples_total': (self.count_samples, "Input samples taken by COUNT lines"),
+            'count_bounces_total': (self.count_bounces, "Input samples ignored by the debouncing of COUNT lines"),
+        }
+
+    @staticmethod
+    def format_number(value):
+        if value == float('inf'):
+            return '+Inf'
+        return f"{value:g}" if isinstance(value, float) else str(value)
+
+    def histogram_lines(self, name, histogram, labels=""):
+        r = ""
+        for bound, total in histogram.cumulative():
+            r += f'{self.prefix}{name}_bucket{{{labels}le="{self.format_number(bound)}"}} {total}\n'
+        labels = f"{{{labels[:-1]}}}" if labels else ""
+        r += f"{self.prefix}{name}_sum{labels} {self.format_number(histogram.sum)}\n"
+        r += f"{self.prefix}{name}_count{labels} {histogram.count}\n"
+        return r
+
+    def to_prometheus(self):
+        # text exposition format, e.g. for the textfile collector of the node exporter or to be scraped
+        r = ""
+        for name, (value, description) in self.counters().items():
+            r += f"# HELP {self.prefix}{name} {description}\n# TYPE {self.prefix}{name} counter\n"
+            r += f"{self.prefix}{name} {value}\n"
+        for name, description in self.histogram_help.items():
+            r += f"# HELP {self.prefix}{name} {description}\n# TYPE {self.prefix}{name} histogram\n"
+            r += self.histogram_lines(name, self.histograms[name])
+        # copies, as the program keeps running while being scraped; line numbers are 1-based as displayed
+        line_steps = sorted(self.line_steps.items())
+        line_times = sorted(self.line_times.items())
+        r += f"# HELP {self.prefix}line_steps_total Executions per line\n"
+        r += f"# TYPE {self.prefix}line_steps_total counter\n"
+        for line_no, steps in line_steps:
+            r += f'{self.prefix}line_steps_total{{line="{line_no + 1}"}} {steps}\n'
+        r += f"# HELP {self.prefix}line_seconds Time from the start of a line until the next line\n"
+        r += f"# TYPE {self.prefix}line_seconds histogram\n"
+        for line_no, histogram in line_times:
+            r += self.histogram_lines('line_seconds', histogram, f'line="{line_no + 1}",')
+        return r
+
+    def write(self, filename):
+        # replace the file at once so that a collector never reads a partial file
+        temporary_filename = filename + ".tmp"
+        with open(temporary_filename, "w") as metrics_file:
+            metrics_file.write(self.to_prometheus())
+        os.replace(temporary_filename, filename)
+
+    def serve(self, port=9464, host='127.0.0.1'):
+        # local HTTP endpoint serving the metrics in the background; returns the server for shutdown()
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # do not mess up the terminal
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        init_threading()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def summary(self):
+        def ms(value):
+            return f"{value * 1000:9.3f} ms" if value is not None else "        - ms"
+
+        def seconds(value):
+            return f"{value:10.3f} s" if value is not None else "         - s"
+
+        r = f"Profile after {monotonic() - self.start:.1f} s: {sum(self.line_steps.values())} steps, " \
+            f"{self.program.serial_writes} serial writes ({self.program.skipped_writes} skipped), " \
+            f"{self.program.timing.resyncs} resyncs\n"
+        r += "                              count          mean           max\n"
+        for name in ('serial_write_seconds', 'echo_read_seconds', 'render_seconds', 'sleep_overshoot_seconds'):
+            h = self.histograms[name]
+            r += f"  {name[:-len('_seconds')].replace('_', ' '):<24}{h.count:>9}  " \
+                 f"{ms(h.sum / h.count if h.count else None)}  {ms(h.max)}\n"
+        h = self.histograms['count_polls_per_edge']
+        if h.count:
+            r += f"  {'COUNT polls per edge':<24}{h.count:>9}  {h.sum / h.count:12.1f}  {h.max:12.1f}\n"
+        r += "  line  label          steps    time total          mean           max\n"
+        for line_no, steps in sorted(self.line_steps.items()):
+            h = self.line_times.get(line_no)
+            label = self.program.instructions[line_no].label if line_no < len(self.program.instructions) else ""
+            r += f"  {line_no + 1:>4}  {label:<12}{steps:>8}  {seconds(h.sum if h else None)}  " \
+                 f"{seconds(h.sum / h.count if h else None)}  {seconds(h.max if h else None)}\n"
+        return r
+
+
+def simulate_file(filename, input_trace=None, max_steps=100000, max_time=3600, cache_directory=None, optimize=False,
+                  vcd_filename=None):
+    # load, check and execute a save file on a simulated Interface A; returns a dictionary with the results;
+    # optionally writes the timeline of the outputs and inputs as Value Change Dump
+    result = {'file': filename, 'lines': None, 'steps': 0, 'duration': 0, 'outputs': None, 'output_changes': 0,
+              'completed': False, 'error': None}
+    p = BrickLines()
+    try:
+        cache = None if cache_directory is None else BrickProgramCache(cache_directory)
+        p.from_file(filename, cache=cache)
+        result['lines'] = len(p.instructions)
+        p.check()
+        interface = p.simulate(input_trace)
+        start_time = p.clock.now()
+        limiter = BrickLimiter(p, max_steps, max_time, interface)
+        observers = [limiter]
+        if vcd_filename is not None:
+            observers.append(BrickVcdWriter(p, vcd_filename, lines=True))
+        try:
+            p.run(headless=True, observers=observers, optimize=optimize)
+            result['completed'] = True
+        except BrickExecutionLimit as e:
+            result['error'] = str(e)
+        finally:
+            if vcd_filename is not None:
+                observers[-1].close()
+        result['steps'] = min(limiter.steps, max_steps) if max_steps is not None else limiter.steps
+        result['duration'] = p.clock.now() - start_time
+        result['outputs'] = interface.out_bit_pattern
+        result['output_changes'] = len(interface.output_log)
+        if optimize:
+            result['optimization'] = p.optimization
+    except AssertionError as e:
+        result['error'] = str(e) or "Assertion failed"
+    except Exception as e:
+        # e.g. a file which is no save file at all; must not take down the other files of a batch
+        result['error'] = f"{type(e).__name__}: {e}"
+    return result
+
+
+def simulate_files(filenames, input_traces=None, max_steps=100000, max_time=3600, jobs=None, cache_directory=None,
+                   optimize=False, vcd_directory=None):
+    # execute many save files in a process pool; input_traces is either a single trace for all files or a
+    # dictionary with a trace per file name (without directory); yields the results in the order of filenames;
+    # with a vcd_directory, a Value Change Dump is written per file (named like the file plus '.vcd')
+    from concurrent.futures import ProcessPoolExecutor
+
+    def trace_for(filename):
+        if isinstance(input_traces, dict):
+            return input_traces.get(os.path.basename(filename))
+        return input_traces
+
+    def vcd_for(filename):
+        if vcd_directory is None:
+            return None
+        return os.path.join(vcd_directory, os.path.basename(filename) + '.vcd')
+
+    if vcd_directory is not None:
+        os.makedirs(vcd_directory, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(simulate_file, filename, trace_for(filename), max_steps, max_time,
+                                   cache_directory, optimize, vcd_for(filename))
+                   for filename in filenames]
+        for future in futures:
+            yield future.result()
+
+
+def convert_file(filename, output_filename, file_format, cache=None, truncate_labels=False):
+    # convert a save file into another format (or just rewrite it); returns a tuple of an error message (or None)
+    # and a list of warnings; with truncate_labels, labels too long for the format are shortened with a warning
+    # instead of failing
+    p = BrickLines()
+    warnings = []
+    try:
+        p.from_file(filename, cache=cache)
+        if truncate_labels:
+            warnings = p.truncate_labels(file_format)
+        content = p.to_bytes(file_format)
+        with open(output_filename, "wb") as file:
+            file.write(content)
+    except AssertionError as e:
+        return str(e) or "Assertion failed", warnings
+    except Exception as e:
+        # e.g. labels which cannot be encoded or files which are no save files at all; must not take down the
+        # other files of a batch
+        return f"{type(e).__name__}: {e}", warnings
+    return None, warnings
+
+
+def convert_files(filenames, output_directory, file_format, cache=None, truncate_labels=False):
+    # convert many save files into output_directory, replacing the file name extensions;
+    # yields tuples of (filename, output_filename, error, warnings)
+    os.makedirs(output_directory, exist_ok=True)
+    for filename in filenames:
+        name = os.path.splitext(os.path.basename(filename))[0] + FILE_EXTENSIONS[file_format]
+        output_filename = os.path.join(output_directory, name)
+        yield (filename, output_filename) + convert_file(filename, output_filename, file_format, cache,
+                                                         truncate_labels)
+
+
+class BrickDevice(BrickObserver):
+    # a program on one Interface A, driven by BrickSupervisor; observes its program to report its status
+
+    def __init__(self, name, program, serial_port):
+        self.name = name
+        self.program = program
+        self.serial_port = serial_port
+        self.task = None
+        self.connected = False
+        self.state = 'idle'
+        self.line_no = None
+        self.out_bit_pattern = None
+        self.error = None
+
+    def on_line(self, line_no):
+        self.line_no = line_no
+
+    def on_output(self, bit_pattern):
+        self.out_bit_pattern = bit_pattern
+
+    async def run(self):
+        import asyncio
+        self.state = 'running'
+        self.error = None
+        try:
+            if not self.connected:
+                await self.program.connect_async(self.serial_port)
+                self.connected = True
+            await self.program.run_async(observers=[self])
+        except asyncio.CancelledError:
+            self.state = 'stopped'
+            # do not leave motors running
+            self.program.write_outputs(b'\x00')
+            self.out_bit_pattern = 0
+            raise
+        except Exception as e:
+            self.state = 'failed'
+            self.error = e
+            raise
+        self.state = 'finished'
+
+    def status(self):
+        return {'state': self.state, 'line_no': self.line_no, 'out_bit_pattern': self.out_bit_pattern,
+                'error': None if self.error is None else repr(self.error)}
+
+
+class BrickSupervisor:
+    # drives several programs on several Interface A boxes (one program per serial port) from one asyncio event loop
+
+    def __init__(self):
+        self.devices = {}
+
+    def add(self, name, program, serial_port):
+        assert name not in self.devices, "Device name already in use"
+        self.devices[name] = BrickDevice(name, program, serial_port)
+
+    def start(self, name):
+        # needs to be called from within the event loop
+        import asyncio
+        device = self.devices[name]
+        assert (device.task is None) or device.task.done(), "Device is already running"
+        device.task = asyncio.get_running_loop().create_task(device.run())
+        return device.task
+
+    async def stop(self, name):
+        import asyncio
+        device = self.devices[name]
+        if (device.task is not None) and not device.task.done():
+            device.task.cancel()
+            await asyncio.gather(device.task, return_exceptions=True)
+
+    def status(self, name=None):
+        if name is not None:
+            return self.devices[name].status()
+        return {name: device.status() for name, device in self.devices.items()}
+
+    async def run(self):
+        # start all devices and wait until all of them have finished (or have been stopped)
+        import asyncio
+        tasks = [self.start(name) for name in self.devices]
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return self.status()
+
+
+# frames between BrickDaemon and BrickDaemonConnection: two bytes each, the kind of the frame and a value; the value of
+# the frames sent by the daemon is a byte as echoed by Interface A (IN7 and IN6 in bits 7 and 6, outputs in bits 5..0)
+DAEMON_WRITE = ord('W')  # set the outputs to the value; answered with DAEMON_ECHO or DAEMON_DENIED
+DAEMON_READ = ord('R')  # read the inputs without setting the outputs; answered with DAEMON_ECHO
+DAEMON_SUBSCRIBE = ord('S')  # value 1 (0): start (stop) sending a DAEMON_SAMPLE on every change of the inputs
+DAEMON_RELEASE = ord('F')  # free the outputs (turning them off) for other clients
+DAEMON_ECHO = ord('E')
+DAEMON_DENIED = ord('D')  # the outputs are owned by another client
+DAEMON_SAMPLE = ord('I')
+
+
+def daemon_address(address):
+    # 'host:port' (or ':port' for localhost) is a TCP address, anything else the path of a Unix domain socket;
+    # returns the address family and the address as used by the socket module
+    init_socket()
+
+    host, _, port = address.rpartition(':')
+    if port.isdigit():
+        return socket.AF_INET, (host or 'localhost', int(port))
+    assert hasattr(socket, 'AF_UNIX'), "No Unix domain sockets on this platform, use host:port"
+    return socket.AF_UNIX, address
+
+
+class BrickDaemon:
+    # owns the serial connection to Interface A and shares it with several local clients (see BrickDaemonConnection
+    # and BrickLines.connect_daemon()): one client at a time owns the outputs, until it releases them or disconnects,
+    # which turns them off; the inputs are polled in the background, which also keeps the link warm, and every
+    # change is sent to the subscribed clients
+
+    def __init__(self, serial_port, address, poll_rate=100):
+        import socketserver
+        init_socket()
+        init_threading()
+
+        self.program = BrickLines()
+        # the reset of the Arduino and the handshake are only needed once, not for every client
+        self.program.connect(serial_port)
+        self.poll_rate = poll_rate
+        self.lock = threading.Lock()
+        self.owner = None
+        self.clients = 0
+        self.thread = None
+        family, self.address = daemon_address(address)
+        daemon = self
+
+        class ClientHandler(socketserver.BaseRequestHandler):
+            def handle(self):
+                daemon.serve_client(self.request)
+
+        if family == socket.AF_INET:
+            socketserver.ThreadingTCPServer.allow_reuse_address = True
+            self.server = socketserver.ThreadingTCPServer(self.address, ClientHandler)
+        else:
+            import stat
+
+            # remove the socket left behind by a daemon which has not been stopped properly
+            if os.path.exists(self.address) and stat.S_ISSOCK(os.stat(self.address).st_mode):
+                os.unlink(self.address)
+            self.server = socketserver.ThreadingUnixStreamServer(self.address, ClientHandler)
+        self.server.daemon_threads = True
+
+    def start(self):
+        # serve in a background thread until stop() is called
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def serve_forever(self):
+        self.program.start_polling(self.poll_rate)
+        try:
+            self.server.serve_forever()
+        finally:
+            # also when stopped with Ctrl+C
+            self.server.server_close()
+            self.program.stop_polling()
+            self.transceive(0)
+            self.program.serial_connection.close()
+            if isinstance(self.address, str) and os.path.exists(self.address):
+                os.unlink(self.address)
+
+    def echo(self):
+        # state of the inputs as cached by the poller and of the outputs, in the format echoed by Interface A
+        in7, in6 = self.program.poller.inputs()
+        return (in7 << 7) | (in6 << 6) | self.program.last_out_bit_pattern[0]
+
+    def transceive(self, bit_pattern):
+        tx = bytes((bit_pattern,))
+        # the poller repeats the last bit pattern; both need to change together
+        with self.program.serial_lock:
+            rx = self.program.transceive(tx)
+            self.program.last_out_bit_pattern = tx
+        return rx[0] if rx else None
+
+    def write(self, client, bit_pattern):
+        with self.lock:
+            if self.owner not in (None, client):
+                return DAEMON_DENIED, self.echo()
+            self.owner = client
+        rx = self.transceive(bit_pattern)
+        return DAEMON_ECHO, rx if rx is not None else self.echo()
+
+    def release(self, client):
+        with self.lock:
+            if self.owner is not client:
+                return
+            self.owner = None
+        # do not leave motors running without anyone in control
+        self.transceive(0)
+
+    def serve_client(self, connection):
+        send_lock = threading.Lock()
+        subscribed = threading.Event()
+
+        def send(kind, value):
+            with send_lock:
+                connection.sendall(bytes((kind, value)))
+
+        def send_samples():
+            poller = self.program.poller
+            sequence = poller.state()[0]
+            try:
+                while subscribed.is_set() and poller.running:
+                    for sequence, _, in7, in6 in poller.wait_changes(sequence, timeout=0.1):
+                        send(DAEMON_SAMPLE, (in7 << 7) | (in6 << 6) | self.program.last_out_bit_pattern[0])
+            except OSError:
+                pass  # client has gone
+
+        if isinstance(self.address, tuple):
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.lock:
+            self.clients += 1
+        frames = connection.makefile('rb')
+        try:
+            while True:
+                frame = frames.read(2)
+                if len(frame) < 2:
+                    break
+                kind, value = frame
+                if kind == DAEMON_WRITE:
+                    send(*self.write(connection, value))
+                elif kind == DAEMON_READ:
+                    send(DAEMON_ECHO, self.echo())
+                elif kind == DAEMON_SUBSCRIBE:
+                    if value and not subscribed.is_set():
+                        subscribed.set()
+                        threading.Thread(target=send_samples, daemon=True).start()
+                    elif not value:
+                        subscribed.clear()
+                elif kind == DAEMON_RELEASE:
+                    self.release(connection)
+                else:
+                    break  # not speaking our protocol
+        except OSError:
+            pass  # connection reset by the client
+        finally:
+            subscribed.clear()
+            frames.close()
+            self.release(connection)
+            with self.lock:
+                self.clients -= 1
+
+
+class BrickDaemonConnection:
+    # connection to Interface A shared by a BrickDaemon; mimics the subset of pyserial's API used by BrickLines
+    # (see BrickLines.connect_daemon()) and additionally allows to subscribe to the changes of the inputs, e.g. for
+    # monitoring them while another client runs a program
+
+    def __init__(self, address):
+        from collections import deque
+        init_socket()
+
+        family, address = daemon_address(address)
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.connect(address)
+        if family == socket.AF_INET:
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.timeout = None
+        self.frames = bytearray()  # received bytes not yet forming a whole frame
+        self.rx_buffer = bytearray()  # echoes of writes and reads
+        self.samples = deque()  # tuples (in7, in6, out bit pattern)
+
+    def receive(self, timeout):
+        # wait up to timeout seconds (None: forever, 0: not at all) for data from the daemon and sort its frames
+
+        self.socket.settimeout(timeout)
+        try:
+            data = self.socket.recv(4096)
+        except (BlockingIOError, socket.timeout):
+            return
+        assert data, "Connection closed by the daemon"
+        self.frames += data
+        denied = False
+        for index in range(0, len(self.frames) - 1, 2):
+            kind, value = self.frames[index], self.frames[index + 1]
+            if kind == DAEMON_SAMPLE:
+                self.samples.append((bool(value & (1 << 7)), bool(value & (1 << 6)), value & 0x3F))
+            else:
+                self.rx_buffer.append(value)
+                denied = denied or (kind == DAEMON_DENIED)
+        del self.frames[:len(self.frames) & ~1]
+        assert not denied, "The outputs of Interface A are used by another client of the daemon"
+
+    def wait(self, ready, timeout):
+        deadline = None if timeout is None else monotonic() + timeout
+        while not ready():
+            remaining = None if deadline is None else deadline - monotonic()
+            if (remaining is not None) and (remaining <= 0):
+                return False
+            self.receive(remaining)
+        return True
+
+    def write(self, data):
+        self.socket.sendall(b''.join(bytes((DAEMON_WRITE, b)) for b in data))
+        return len(data)
+
+    def read(self, size=1):
+        self.wait(lambda: len(self.rx_buffer) >= size, self.timeout)
+        rx = bytes(self.rx_buffer[:size])
+        del self.rx_buffer[:size]
+        return rx
+
+    @property
+    def in_waiting(self):
+        self.receive(0)
+        return len(self.rx_buffer)
+
+    def reset_input_buffer(self):
+        self.receive(0)
+        self.rx_buffer.clear()
+
+    def reset_output_buffer(self):
+        pass
+
+    def close(self):
+        self.socket.close()
+
+    def state(self):
+        # current state (in7, in6, out bit pattern) without taking over the outputs
+        self.socket.sendall(bytes((DAEMON_READ, 0)))
+        self.wait(lambda: self.rx_buffer, None)
+        value = self.rx_buffer.pop(0)
+        return bool(value & (1 << 7)), bool(value & (1 << 6)), value & 0x3F
+
+    def subscribe(self, enable=True):
+        self.socket.sendall(bytes((DAEMON_SUBSCRIBE, int(enable))))
+
+    def next_sample(self, timeout=None):
+        # next change of the inputs as (in7, in6, out bit pattern) after subscribe(); None on timeout
+        if self.wait(lambda: self.samples, timeout):
+            return self.samples.popleft()
+        return None
+
+    def release(self):
+        self.socket.sendall(bytes((DAEMON_RELEASE, 0)))
+
+
+class BrickPtyInterface:
+    # stand-in for the Arduino on a pseudo terminal (POSIX only): port names a serial device which answers like the
+    # serial to parallel converter, e.g. to try the daemon or other tools without hardware; behind it is a
+    # BrickSimulatedInterface on the wall clock (see interface for its inputs and output log)
+
+    def __init__(self, input_trace=None):
+        import pty
+        import tty
+        init_threading()
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        clock = BrickClock()
+        # the times of the input trace are relative to now
+        if input_trace is not None:
+            input_trace = [(clock.now() + t, in7, in6) for t, in7, in6 in input_trace]
+        self.interface = BrickSimulatedInterface(clock, input_trace)
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        import select
+
+        while self.running:
+            if not select.select([self.master], [], [], 0.1)[0]:
+                continue
+            data = os.read(self.master, 256)
+            self.interface.write(data)
+            os.write(self.master, self.interface.read(len(data)))
+
+    def set_inputs(self, in7, in6):
+        self.interface.set_inputs(in7, in6)
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+
 if __name__ == '__main__':
+    if (len(sys.argv) == 3) and (sys.argv[1] in ('-f', '--file')):
+        # fast path for just printing a save file (e.g. in scripts looping over many files): no need to load argparse
+        p = BrickLines()
+        p.from_file(sys.argv[2])
+        p.print(clear_screen=False)
+        sys.exit(0)
+
     import argparse
 
     parser = argparse.ArgumentParser(description="BRICK Lines")
-    parser.add_argument("-f", "--file", required=True, help="Input file name")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("-f", "--file", help="Input file name")
+    source.add_argument("--batch", metavar="DIRECTORY",
+                        help="Simulate all save files in a directory and print the results as JSON lines")
+    source.add_argument("--scan", metavar="IMAGE",
+                        help="Print all Commodore save files found in a disk image, an archive or a dump")
+    source.add_argument("--serve", metavar="ADDRESS",
+                        help="Share Interface A (-s) with several clients as a daemon listening on a Unix domain "
+                             "socket path or host:port")
+    source.add_argument("--monitor", metavar="ADDRESS",
+                        help="Print the changes of the inputs of Interface A shared by a daemon (see --serve)")
     parser.add_argument("-s", "--serial-port",
                         help="Name of serial device to Interface A; required to run a program on")
+    parser.add_argument("--headless", action="store_true",
+                        help="Run the program without displaying it")
+    parser.add_argument("--simulate", action="store_true",
+                        help="Run the program on a simulated Interface A with fast-forwarded waits")
+    parser.add_argument("--poll-rate", type=float,
+                        help="Poll the inputs in the background with the given rate (in Hz)")
+    parser.add_argument("--daemon", metavar="ADDRESS",
+                        help="Run the program on Interface A shared by a daemon (see --serve) instead of -s")
+    parser.add_argument("--explore", type=int, metavar="STEPS",
+                        help="Execute the program against all sequences of STEPS input values (or as many random "
+                             "ones as --scenarios) and print which lines and branches were covered; needs numpy")
+    parser.add_argument("--scenarios", type=int, default=4096,
+                        help="Maximum number of scenarios for --explore (default: 4096)")
+    parser.add_argument("--step-time", type=float, default=1,
+                        help="Duration of each input value of the scenarios of --explore in seconds (default: 1)")
+    parser.add_argument("--equivalent", metavar="FILE",
+                        help="With --explore, check whether another save file sets the outputs the same way in all "
+                             "scenarios")
+    parser.add_argument("--watch", action="store_true",
+                        help="Reload the running program whenever its file changes, without reconnecting")
+    parser.add_argument("--input-trace",
+                        help="JSON file with a list of [time, in7, in6] for all programs or a dictionary of such "
+                             "lists per file name (batch mode only)")
+    parser.add_argument("--max-steps", type=int, default=100000,
+                        help="Maximum number of lines to execute per program (batch mode only)")
+    parser.add_argument("--max-time", type=float, default=3600,
+                        help="Maximum simulated run time per program in seconds (batch mode only)")
+    parser.add_argument("--cache", metavar="DIRECTORY", nargs='?', const='',
+                        help="Cache parsed programs in a directory (default: ~/.cache/brick_lines)")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="Number of processes (batch mode only); defaults to the number of CPUs")
+    parser.add_argument("--convert", choices=['commodore', 'apple'],
+                        help="Convert the save file (or all save files in batch mode) into the given format")
+    parser.add_argument("-o", "--output",
+                        help="Output file name (or directory in batch mode) for --convert")
+    parser.add_argument("--truncate-labels", action="store_true",
+                        help="With --convert, shorten labels too long for the format (with a warning) instead of "
+                             "failing")
+    parser.add_argument("--analyze", action="store_true",
+                        help="Print the duration of the program (or of all programs in batch mode, as JSON lines) "
+                             "computed without running it")
+    parser.add_argument("--optimize", action="store_true",
+                        help="Merge and remove redundant lines before running the program and print the savings")
+    parser.add_argument("--arduino", metavar="HEADER",
+                        help="Compile the program into bytecode for the Lines executor sketch and write it as C header "
+                             "(program.h in hardware/lines_executor/lines_executor)")
+    parser.add_argument("--record", metavar="TRACE",
+                        help="Record the executed lines, outputs and inputs into a binary trace file")
+    parser.add_argument("--replay", metavar="TRACE",
+                        help="Execute the program with the inputs recorded in a trace file (on virtual time)")
+    parser.add_argument("--vcd", metavar="FILE",
+                        help="Write the timeline of the outputs and inputs as Value Change Dump (a directory in batch "
+                             "mode; a trace file given with -f is converted)")
+    parser.add_argument("--profile", action="store_true",
+                        help="Print where the time went (I/O latencies, rendering, waits and lines) after running")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="Write the metrics of the run to a file in the text format of Prometheus")
+    parser.add_argument("--metrics-port", type=int, metavar="PORT",
+                        help="Serve the metrics of the run via HTTP on localhost at the given port")
     args = parser.parse_args()
+    if args.watch and args.optimize:
+        parser.error("--watch cannot be combined with --optimize")
+
+    if args.serve is not None:
+        if args.serial_port is None:
+            parser.error("--serve requires --serial-port")
+        daemon = BrickDaemon(args.serial_port, args.serve, args.poll_rate or 100)
+        print(f"Sharing Interface A on {args.serial_port} at {args.serve}")
+        try:
+            daemon.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    if args.monitor is not None:
+        connection = BrickDaemonConnection(args.monitor)
+        connection.subscribe()
+        start = monotonic()
+        sample = connection.state()
+        try:
+            while True:
+                in7, in6, out_bit_pattern = sample
+                print(f"{monotonic() - start:10.3f} s  IN7={in7:d}  IN6={in6:d}  outputs={out_bit_pattern:06b}",
+                      flush=True)
+                sample = connection.next_sample()
+        except KeyboardInterrupt:
+            pass
+        sys.exit(0)
+
+    if args.scan is not None:
+        # with --convert, extract the save files into the --output directory instead of printing them
+        if (args.convert is not None) and (args.output is None):
+            parser.error("--convert requires --output")
+        if args.convert is not None:
+            os.makedirs(args.output, exist_ok=True)
+        failed = 0
+        for offset, p in BrickLines.scan_file_commodore(args.scan):
+            if args.convert is None:
+                print(f"{args.scan} @ 0x{offset:X}:")
+                p.print(clear_screen=False)
+                continue
+            file_format = BrickFileFormat.COMMODORE if args.convert == 'commodore' else BrickFileFormat.APPLE_II
+            name = f"{os.path.splitext(os.path.basename(args.scan))[0]}_{offset:X}{FILE_EXTENSIONS[file_format]}"
+            try:
+                if args.truncate_labels:
+                    for warning in p.truncate_labels(file_format):
+                        print(f"{args.scan} @ 0x{offset:X}: {warning}", file=sys.stderr)
+                p.to_file(os.path.join(args.output, name), file_format)
+                print(f"{args.scan} @ 0x{offset:X} -> {os.path.join(args.output, name)}")
+            except AssertionError as e:
+                print(f"{args.scan} @ 0x{offset:X}: {e}", file=sys.stderr)
+                failed += 1
+        sys.exit(1 if failed else 0)
+
+    if args.convert is not None:
+        if args.output is None:
+            parser.error("--convert requires --output")
+        file_format = BrickFileFormat.COMMODORE if args.convert == 'commodore' else BrickFileFormat.APPLE_II
+        cache = None if args.cache is None else BrickProgramCache(args.cache or None)
+        if args.batch is not None:
+            files = sorted(os.path.join(args.batch, f) for f in os.listdir(args.batch)
+                           if os.path.isfile(os.path.join(args.batch, f)))
+            failed = 0
+            for filename, output_filename, error, warnings in convert_files(files, args.output, file_format, cache,
+                                                                            args.truncate_labels):
+                for warning in warnings:
+                    print(f"{filename}: {warning}", file=sys.stderr)
+                if error is None:
+                    print(f"{filename} -> {output_filename}")
+                else:
+                    print(f"{filename}: {error}", file=sys.stderr)
+                    failed += 1
+            sys.exit(1 if failed else 0)
+        error, warnings = convert_file(args.file, args.output, file_format, cache, args.truncate_labels)
+        for warning in warnings:
+            print(f"{args.file}: {warning}", file=sys.stderr)
+        if error is not None:
+            print(f"{args.file}: {error}", file=sys.stderr)
+            sys.exit(1)
+        sys.exit(0)
+
+    if args.arduino is not None:
+        p = BrickLines()
+        p.from_file(args.file, cache=None if args.cache is None else BrickProgramCache(args.cache or None))
+        p.check()
+        with open(args.arduino, "w") as header_file:
+            header_file.write(p.to_arduino_header())
+        sys.exit(0)
+
+    if args.explore is not None:
+        if args.file is None:
+            parser.error("--explore requires --file")
+        cache = None if args.cache is None else BrickProgramCache(args.cache or None)
+        p = BrickLines()
+        p.from_file(args.file, cache=cache)
+        if 4 ** args.explore <= args.scenarios:
+            scenarios = BrickScenarioExplorer.all_scenarios(args.explore)
+        else:
+            # reproducible from run to run
+            scenarios = BrickScenarioExplorer.random_scenarios(args.scenarios, args.explore, seed=0)
+        explorer = BrickScenarioExplorer(p, scenarios, args.step_time).run()
+        print(explorer.summary(), end='')
+        if args.equivalent is None:
+            sys.exit(0)
+        q = BrickLines()
+        q.from_file(args.equivalent, cache=cache)
+        other = BrickScenarioExplorer(q, scenarios, args.step_time).run()
+        r = explorer.compare(other)
+        if r['inconclusive']:
+            print(f"{len(r['inconclusive'])} scenarios are inconclusive (step limit)")
+        if r['equivalent']:
+            print(f"Same outputs as {args.equivalent} in all {r['scenarios']} scenarios")
+            sys.exit(0)
+        scenario = r['differing'][0]
+        print(f"Other outputs than {args.equivalent} in {len(r['differing'])} of {r['scenarios']} scenarios, e.g. "
+              f"with the inputs {explorer.show_scenario(scenario)}:")
+        print(f"  {args.file}: {explorer.show_timeline(scenario)}")
+        print(f"  {args.equivalent}: {other.show_timeline(scenario)}")
+        sys.exit(1)
+
+    if args.analyze:
+        import json
+
+        def finite(o):
+            # JSON has no infinity, unbounded durations are null
+            if isinstance(o, dict):
+                return {k: finite(v) for k, v in o.items()}
+            if isinstance(o, (list, tuple)):
+                return [finite(v) for v in o]
+            return None if o == float('inf') else o
+
+        cache = None if args.cache is None else BrickProgramCache(args.cache or None)
+        if args.batch is None:
+            p = BrickLines()
+            p.from_file(args.file, cache=cache)
+            p.check()
+            print(BrickLines.show_analysis(p.analyze()), end='')
+            sys.exit(0)
+        for filename in sorted(os.path.join(args.batch, f) for f in os.listdir(args.batch)
+                               if os.path.isfile(os.path.join(args.batch, f))):
+            r = {'file': filename, 'error': None}
+            p = BrickLines()
+            try:
+                p.from_file(filename, cache=cache)
+                p.check()
+                r.update(p.analyze())
+            except AssertionError as e:
+                r['error'] = str(e) or "Assertion failed"
+            except Exception as e:
+                # same as simulate_file(): one bad file must not take down the batch
+                r['error'] = f"{type(e).__name__}: {e}"
+            print(json.dumps(finite(r)), flush=True)
+        sys.exit(0)
+
+    if args.batch is not None:
+        import json
+
+        traces = None
+        if args.input_trace is not None:
+            with open(args.input_trace) as trace_file:
+                traces = json.load(trace_file)
+        files = sorted(os.path.join(args.batch, f) for f in os.listdir(args.batch)
+                       if os.path.isfile(os.path.join(args.batch, f)))
+        cache_directory = None
+        if args.cache is not None:
+            cache_directory = BrickProgramCache(args.cache or None).directory
+        for r in simulate_files(files, traces, args.max_steps, args.max_time, args.jobs, cache_directory,
+                                args.optimize, args.vcd):
+            print(json.dumps(r), flush=True)
+        sys.exit(0)
+
+    if args.vcd is not None:
+        with open(args.file, "rb") as trace_file:
+            is_trace = trace_file.read(len(TRACE_MAGIC)) == TRACE_MAGIC
+        if is_trace:
+            BrickVcdWriter.from_trace(args.file, args.vcd)
+            sys.exit(0)
 
     p = BrickLines()
-    p.from_file(args.file)
-    if args.serial_port is not None:
-        p.connect(args.serial_port)
-        p.run()
+    p.from_file(args.file, cache=None if args.cache is None else BrickProgramCache(args.cache or None))
+    if args.vcd is not None:
+        p.add_observer(BrickVcdWriter(p, args.vcd, lines=True))
+    if args.replay is not None:
+        print(BrickTraceReplayer(args.replay).replay(p, headless=args.headless, optimize=args.optimize))
+        sys.exit(0)
+    if args.record is not None:
+        p.add_observer(BrickTraceRecorder(p, args.record))
+    if args.profile or (args.metrics is not None) or (args.metrics_port is not None):
+        p.enable_metrics()
+        if args.metrics_port is not None:
+            p.metrics.serve(args.metrics_port)
+    if args.simulate or (args.serial_port is not None) or (args.daemon is not None):
+        if args.simulate:
+            p.simulate()
+        else:
+            if args.daemon is not None:
+                p.connect_daemon(args.daemon)
+            else:
+                p.connect(args.serial_port)
+            if args.poll_rate is not None:
+                p.start_polling(args.poll_rate)
+        if args.watch:
+            p.enable_hot_swap().watch(args.file)
+        try:
+            p.run(headless=args.headless, optimize=args.optimize)
+        finally:
+            # also when stopped with Ctrl+C
+            if args.profile:
+                print(p.metrics.summary(), end='')
+            if args.metrics is not None:
+                p.metrics.write(args.metrics)
     else:
         p.print(clear_screen=False)
+        if args.optimize:
+            p.check()
+            p.optimization = p.optimize()[2]
+    if args.optimize:
+        o = p.optimization
+        print(f"Optimized {o['lines_before']} into {o['lines_after']} lines, saved at least {o['transactions']} "
+              f"serial transaction(s) (about {o['time']:g} s) per run")
@@ -0,0 +1,194 @@
+// Lines executor: runs a BRICK Lines program directly on the Arduino instead of remote controlling the outputs
+// via the serial connection; the program is compiled into a bytecode image by brick_lines.py (--arduino)
+// and included as "program.h"
+//
+// Same pinout as the serial to parallel converter, see ../../serial2parallel_converter
+// The host-side reference of this interpreter is BrickBytecodeEmulator in brick_lines.py; keep both in sync!
+//
+// Works on Arduino Uno R3 and
+// Arduino Nano using the "Processor: ATmega328P/old bootloader" option in menu Tools
+
+#include "program.h"
+
+// opcodes, see OP_* in brick_lines.py
+#define OP_SET_OUTPUT 0
+#define OP_REPEAT     1
+#define OP_UNTIL      2
+#define OP_ENDREPEAT  3
+#define OP_FOREVER    4
+#define OP_IF         5
+#define OP_ENDIF      6
+#define OP_COUNT      7
+
+// COUNT edge selection, see BrickEdge in brick_lines.py
+#define EDGE_RISING   1
+#define EDGE_FALLING  2
+#define EDGE_BOTH     3
+
+#define BYTECODE_VERSION 1
+#define HEADER_SIZE   12                      // magic, version, edge, number of lines, debounce time
+#define RECORD_SIZE   8                       // opcode, operand, target, argument
+#define NUM_LINES     ((sizeof(program_image) - HEADER_SIZE) / RECORD_SIZE)
+
+#define RESYNC_THRESHOLD 50000L               // restart the timeline if a deadline lies back further (us)
+
+uint32_t loop_counters[NUM_LINES];
+uint32_t deadline;
+bool deadline_valid = false;
+
+uint8_t record_opcode(uint16_t line_no) {
+  return pgm_read_byte(program_image + HEADER_SIZE + line_no * RECORD_SIZE);
+}
+
+uint8_t record_operand(uint16_t line_no) {
+  return pgm_read_byte(program_image + HEADER_SIZE + line_no * RECORD_SIZE + 1);
+}
+
+uint16_t record_target(uint16_t line_no) {
+  return pgm_read_word(program_image + HEADER_SIZE + line_no * RECORD_SIZE + 2);
+}
+
+uint32_t record_argument(uint16_t line_no) {
+  return pgm_read_dword(program_image + HEADER_SIZE + line_no * RECORD_SIZE + 4);
+}
+
+uint8_t read_inputs() {
+  uint8_t inputs = PINB & B00000011;          // Sensors 6+7 on 9750 (open = 1 because of the pull-ups)
+  PORTB = (PORTB & B11110011) | (inputs << 2);
+                                              // LEDs on port B 2+3 showing the sensor status (optional);
+                                              // keep the pull-ups of ports B0/B1 enabled
+  return inputs;                              // bit 1: IN7, bit 0: IN6
+}
+
+bool check_condition(uint8_t condition) {
+  // two bits per input: 0 = any value, 1 = 0, 2 = 1; IN7 in bits 3..2, IN6 in bits 1..0
+  uint8_t inputs = read_inputs();
+  uint8_t in7_condition = condition >> 2;
+  uint8_t in6_condition = condition & 0x03;
+  if (in7_condition && (((inputs >> 1) & 1) != (in7_condition == 2))) {
+    return false;
+  }
+  if (in6_condition && ((inputs & 1) != (in6_condition == 2))) {
+    return false;
+  }
+  return true;
+}
+
+void set_outputs(uint8_t bit_pattern, uint32_t wait_time) {
+  // waits end at absolute deadlines so that the execution of the lines in between does not add up
+  uint32_t now = micros();
+  if (!deadline_valid || (int32_t)(now - deadline) > RESYNC_THRESHOLD) {
+    deadline = now;
+    deadline_valid = true;
+  }
+  PORTD = (PORTD & B00000011) | (bit_pattern << 2);
+                                              // Outputs 0-5 on 9750 = PORTD 2-7, keep RX/TX untouched
+  deadline += wait_time;
+  while ((int32_t)(micros() - deadline) < 0) {}
+}
+
+void count_changes(uint8_t condition, uint32_t count) {
+  // count edges of the selected inputs; after an accepted edge, changes of that input are ignored for the
+  // debounce time and only accepted afterward if the input still differs (same as BrickEdgeCounter)
+  uint8_t edge = pgm_read_byte(program_image + 5);
+  uint32_t debounce = pgm_read_dword(program_image + 8);
+  uint8_t watch = ((condition >> 2) ? 2 : 0) | ((condition & 0x03) ? 1 : 0);
+  uint8_t levels = read_inputs();
+  uint32_t last_edge_times[2];
+  uint8_t has_edge = 0;
+  uint32_t edges = 0;
+  while (edges < count) {
+    uint8_t inputs = read_inputs();
+    uint32_t now = micros();
+    for (uint8_t index = 0; index < 2; index++) {
+      uint8_t mask = 1 << index;
+      if (!(watch & mask) || ((inputs ^ levels) & mask) == 0) {
+        continue;
+      }
+      if ((has_edge & mask) && (now - last_edge_times[index] < debounce)) {
+        continue;                             // bouncing
+      }
+      levels ^= mask;
+      last_edge_times[index] = now;
+      has_edge |= mask;
+      bool level = inputs & mask;
+      if ((edge == EDGE_BOTH) || ((edge == EDGE_RISING) == level)) {
+        edges++;
+      }
+    }
+  }
+}
+
+void run_program() {
+  uint16_t line_no = 0;
+  uint16_t last_line_no = 0;
+  bool has_last_line = false;
+  while (line_no < NUM_LINES) {
+    uint16_t next_line_no = line_no + 1;
+    uint16_t target = record_target(line_no);
+    switch (record_opcode(line_no)) {
+      case OP_SET_OUTPUT:
+        set_outputs(record_operand(line_no), record_argument(line_no));
+        break;
+      case OP_REPEAT:
+        // entering the loop from a line above resets its counter
+        if (!has_last_line || (last_line_no < line_no)) {
+          loop_counters[line_no] = 0;
+        }
+        break;
+      case OP_UNTIL:
+        if (!check_condition(record_operand(line_no))) {
+          loop_counters[target]++;
+          next_line_no = target;
+        }
+        break;
+      case OP_ENDREPEAT:
+        if (loop_counters[target] + 1 < record_argument(target)) {
+          loop_counters[target]++;
+          next_line_no = target;
+        }
+        break;
+      case OP_FOREVER:
+        loop_counters[target]++;
+        next_line_no = target;
+        break;
+      case OP_IF:
+        if (!check_condition(record_operand(line_no))) {
+          next_line_no = target;
+        }
+        break;
+      case OP_ENDIF:
+        break;
+      case OP_COUNT:
+        count_changes(record_operand(line_no), record_argument(line_no));
+        break;
+    }
+    last_line_no = line_no;
+    has_last_line = true;
+    line_no = next_line_no;
+  }
+}
+
+void setup() {
+  // Same IO configuration as the serial to parallel converter
+  pinMode(8, INPUT_PULLUP);                   // Pull-ups need to be defined >before< port direction settings
+  pinMode(9, INPUT_PULLUP);                   // This mimics the behavior of the 9750 sensor ports: Open = true
+  DDRD |= B11111100;                          // Pins 2 to 7 as outputs, RX/TX unchanged
+  DDRB |= B00001100;                          // Ports B2/B3 = outputs (sensor LEDs)
+  DDRB &= B11111100;                          // Ports B0/B1 = inputs
+  PORTD &= B00000011;                         // All outputs off
+
+  if ((pgm_read_byte(program_image) != 'B') || (pgm_read_byte(program_image + 1) != 'L') ||
+      (pgm_read_byte(program_image + 2) != 'B') || (pgm_read_byte(program_image + 3) != 'C') ||
+      (pgm_read_byte(program_image + 4) != BYTECODE_VERSION)) {
+    pinMode(LED_BUILTIN, OUTPUT);             // Not a (supported) bytecode image: light the on-board LED
+    digitalWrite(LED_BUILTIN, HIGH);
+    return;
+  }
+  run_program();
+}
+
+void loop() {
+  // the program has finished (outputs keep their state); keep showing the sensor status
+  read_inputs();
+}
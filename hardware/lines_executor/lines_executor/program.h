@@ -0,0 +1,10 @@
+// generated by brick_lines.py, do not edit
+#include <avr/pgmspace.h>
+
+const uint8_t program_image[44] PROGMEM = {
+  0x42, 0x4C, 0x42, 0x43, 0x01, 0x03, 0x04, 0x00, 0x00, 0x00, 0x00, 0x00,  // header
+  0x01, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,  // 1: REPEAT
+  0x00, 0x01, 0x00, 0x00, 0x20, 0xA1, 0x07, 0x00,  // 2: out0
+  0x00, 0x02, 0x00, 0x00, 0x20, 0xA1, 0x07, 0x00,  // 3: out1
+  0x04, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00,  // 4: FOREVER
+};